@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import base64
+import hashlib
+import json
+import operator
+from datetime import datetime
+from typing import Iterator, Optional
+
+from flask import current_app
+from sqlalchemy import and_, case, func, or_
+
+from app.database import db
+from app.models import Deployments, Instances
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Columns of the admin listing, keyed as in the JSON rows
+LISTING_COLUMNS = {
+    "id": Instances.id,
+    "team": Deployments.team_name,
+    "username": Deployments.user_name,
+    "image": Instances.docker_image,
+    "domain": Deployments.host_domain,
+    "ports": Instances.ports,
+    "instance_name": Instances.instance_name,
+    "date": Deployments.creation_date,
+    "state": Deployments.state,
+}
+
+# Query parameters filtering the listing (case-insensitive substring)
+LISTING_FILTERS = {
+    "team": [Deployments.team_name],
+    "user": [Deployments.user_name],
+    "image": [Instances.docker_image],
+    "host": [Deployments.host_domain],
+    "q": [
+        Deployments.team_name,
+        Deployments.user_name,
+        Instances.docker_image,
+        Instances.instance_name,
+    ],
+}
+
+LISTING_SORTS = {"id": Instances.id, "date": Deployments.creation_date}
+
+
+def encode_cursor(row: dict, sort: str) -> str:
+    value = row[sort].isoformat() if sort == "date" else row[sort]
+    return base64.urlsafe_b64encode(json.dumps([value, row["id"]]).encode()).decode()
+
+
+def decode_cursor(cursor: str, sort: str) -> tuple:
+    """
+    Returns the (sort value, id) of the last row of the previous page, raises
+    ValueError on an invalid cursor.
+    """
+    try:
+        value, instance_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if sort == "date":
+            value = datetime.fromisoformat(value)
+        return value, int(instance_id)
+    except (TypeError, ValueError, json.JSONDecodeError) as err:
+        raise ValueError("Invalid cursor.") from err
+
+
+class InstanceListing:
+    """
+    Filtered, sorted and paginated listing of the containers for the admin API.
+    """
+
+    def __init__(self, args: dict):
+        self.sort = args.get("sort", "id")
+        self.order = args.get("order", "asc")
+        if self.sort not in LISTING_SORTS or self.order not in ["asc", "desc"]:
+            raise ValueError("Invalid sort, expected sort=id|date and order=asc|desc.")
+
+        try:
+            self.limit = min(max(int(args.get("limit", PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        except ValueError as err:
+            raise ValueError("Invalid limit.") from err
+
+        self.filters = {
+            key: args[key].strip()
+            for key in LISTING_FILTERS
+            if args.get(key, "").strip()
+        }
+        self.cursor = (
+            decode_cursor(args["cursor"], self.sort) if args.get("cursor") else None
+        )
+
+    def where(self) -> list:
+        clauses = [
+            or_(
+                *[
+                    column.icontains(value, autoescape=True)
+                    for column in LISTING_FILTERS[key]
+                ]
+            )
+            for key, value in self.filters.items()
+        ]
+
+        if self.cursor:
+            value, instance_id = self.cursor
+            column = LISTING_SORTS[self.sort]
+            after = operator.gt if self.order == "asc" else operator.lt
+            clauses.append(
+                or_(
+                    after(column, value),
+                    and_(column == value, after(Instances.id, instance_id)),
+                )
+            )
+        return clauses
+
+    def etag(self) -> str:
+        """
+        Fingerprint of the rows matching the filters: any creation, removal, claim
+        or stop changes the count, the highest ID, the latest creation date or the
+        count of stopped containers.
+        """
+        count, max_id, max_date, stopped = (
+            db.session.query(
+                func.count(Instances.id),
+                func.max(Instances.id),
+                func.max(Deployments.creation_date),
+                func.sum(case((Deployments.state != "running", 1), else_=0)),
+            )
+            .select_from(Instances)
+            .join(Deployments)
+            .filter(*self.where())
+            .one()
+        )
+        state = [
+            self.sort,
+            self.order,
+            self.limit,
+            sorted(self.filters.items()),
+            self.cursor,
+            count,
+            max_id,
+            max_date,
+            stopped,
+        ]
+        return hashlib.sha256(json.dumps(state, default=str).encode()).hexdigest()[:32]
+
+    def rows(self) -> Iterator[dict]:
+        """
+        Stream the rows of the page, plus one extra row telling if a next page exists.
+        """
+        columns = [column.label(key) for key, column in LISTING_COLUMNS.items()]
+        sort = LISTING_SORTS[self.sort]
+        order_by = (
+            [sort, Instances.id]
+            if self.order == "asc"
+            else [sort.desc(), Instances.id.desc()]
+        )
+
+        query = (
+            db.session.query(*columns)
+            .select_from(Instances)
+            .join(Deployments)
+            .filter(*self.where())
+            .order_by(*order_by)
+            .limit(self.limit + 1)
+            .yield_per(200)
+        )
+        for row in query:
+            yield dict(row._mapping)
+
+    def stream(self) -> Iterator[str]:
+        """
+        Stream the JSON body of the page without building the whole list.
+        """
+        next_cursor: Optional[str] = None
+        yield '{"success": true, "data": ['
+        for i, row in enumerate(self.rows()):
+            if i == self.limit:
+                next_cursor = encode_cursor(last, self.sort)
+                break
+            yield ("," if i else "") + current_app.json.dumps(row)
+            last = row
+        yield '], "next_cursor": ' + json.dumps(next_cursor) + "}"
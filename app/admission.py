@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+import math
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Lock
+
+from app.config import (
+    ADMISSION_TEAM_BURST,
+    ADMISSION_TEAM_RATE,
+    ADMISSION_USER_BURST,
+    ADMISSION_USER_RATE,
+    DOCKER_HOSTS,
+    HOST_MAX_OPERATIONS,
+)
+from app.metrics import REGISTRY, Counter, Gauge
+
+ADMISSION_REJECTED_TOTAL = REGISTRY.register(
+    Counter(
+        "admission_rejected_total",
+        "Deployment requests rejected by the admission control.",
+        ("reason",),
+    )
+)
+
+REJECTION_MESSAGES = {
+    "user": "You requested too many deployments",
+    "team": "Your team requested too many deployments",
+    "queue": "Too many deployments in progress",
+}
+
+# Idle buckets are dropped at most once per interval (seconds)
+PRUNE_INTERVAL = 60
+
+
+class TokenBucket:
+    """
+    `burst` deployments at once, then one every 1/`rate` seconds.
+    """
+
+    def __init__(self, rate: float, burst: int, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def full(self) -> bool:
+        return self.tokens >= self.burst
+
+    def wait_time(self) -> float:
+        """
+        Seconds until a token is available, 0 if one is available now.
+        """
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """
+    Admission of the deployments, in front of the quotas:
+
+    - a token bucket per user and per team limits the rate of the requests;
+    - the create/remove operations of the deployments and teardowns are capped
+      per challenge host, the extra operations wait for a free slot.
+
+    The rates are in deployments per minute, 0 disables the limit.
+    """
+
+    def __init__(
+        self,
+        user_rate: float = ADMISSION_USER_RATE,
+        user_burst: int = ADMISSION_USER_BURST,
+        team_rate: float = ADMISSION_TEAM_RATE,
+        team_burst: int = ADMISSION_TEAM_BURST,
+        host_operations: int = HOST_MAX_OPERATIONS,
+    ):
+        self.user_rate = user_rate / 60
+        self.user_burst = max(user_burst, 1)
+        self.team_rate = team_rate / 60
+        self.team_burst = max(team_burst, 1)
+        self.host_operations = host_operations
+        self.lock = Lock()
+
+        self.user_buckets: dict[int, TokenBucket] = {}
+        self.team_buckets: dict[int, TokenBucket] = {}
+        self.last_prune = time.monotonic()
+        self.admitted = 0
+        self.rejected = defaultdict(int)
+
+        self.slots = {
+            docker_host["domain"]: BoundedSemaphore(host_operations)
+            for docker_host in DOCKER_HOSTS
+        }
+        # {host_domain: operations} running and waiting for a slot
+        self.active = defaultdict(int)
+        self.waiting = defaultdict(int)
+
+    def get_bucket(
+        self, buckets: dict, key: int, rate: float, burst: int, now: float
+    ) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst, now)
+        else:
+            bucket.refill(now)
+        return bucket
+
+    def prune(self, now: float) -> None:
+        """
+        Drop the buckets refilled to their burst, they behave like new ones.
+        """
+        if now - self.last_prune < PRUNE_INTERVAL:
+            return
+        self.last_prune = now
+        for buckets in [self.user_buckets, self.team_buckets]:
+            for key, bucket in list(buckets.items()):
+                bucket.refill(now)
+                if bucket.full:
+                    del buckets[key]
+
+    def reject(self, reason: str, retry_after: float) -> str:
+        """
+        Count a rejected request, returns the message shown to the user.
+        """
+        with self.lock:
+            self.rejected[reason] += 1
+        ADMISSION_REJECTED_TOTAL.inc(reason=reason)
+        seconds = max(math.ceil(retry_after), 1)
+        unit = "second" if seconds == 1 else "seconds"
+        return f"{REJECTION_MESSAGES[reason]}, please retry in {seconds} {unit}."
+
+    def admit(self, user_id: int, team_id: int) -> tuple[bool, str]:
+        """
+        Take a token from the buckets of the user and of the team, only if both
+        have one. Returns False and the message with the wait time otherwise.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.prune(now)
+            limits = [
+                ("user", self.user_buckets, user_id, self.user_rate, self.user_burst),
+                ("team", self.team_buckets, team_id, self.team_rate, self.team_burst),
+            ]
+            buckets = [
+                (reason, self.get_bucket(table, key, rate, burst, now))
+                for reason, table, key, rate, burst in limits
+                if rate > 0
+            ]
+
+            for reason, bucket in buckets:
+                wait_time = bucket.wait_time()
+                if wait_time > 0:
+                    break
+            else:
+                for _, bucket in buckets:
+                    bucket.tokens -= 1
+                self.admitted += 1
+                return True, ""
+
+        return False, self.reject(reason, wait_time)
+
+    @contextmanager
+    def host_operation(self, host_domain: str):
+        """
+        Hold one of the create/remove slots of a challenge host.
+        """
+        with self.lock:
+            slot = self.slots.get(host_domain)
+            if slot is None:
+                slot = self.slots[host_domain] = BoundedSemaphore(self.host_operations)
+            self.waiting[host_domain] += 1
+
+        slot.acquire()
+        with self.lock:
+            self.waiting[host_domain] -= 1
+            self.active[host_domain] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active[host_domain] -= 1
+            slot.release()
+
+    def stats(self) -> dict:
+        """
+        Returns the counters of the admission control.
+        """
+        now = time.monotonic()
+        with self.lock:
+            for buckets in [self.user_buckets, self.team_buckets]:
+                for bucket in buckets.values():
+                    bucket.refill(now)
+            return {
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+                "limited_users": sum(
+                    bucket.tokens < 1 for bucket in self.user_buckets.values()
+                ),
+                "limited_teams": sum(
+                    bucket.tokens < 1 for bucket in self.team_buckets.values()
+                ),
+                "hosts": {
+                    host_domain: {
+                        "active": self.active[host_domain],
+                        "waiting": self.waiting[host_domain],
+                        "max": self.host_operations,
+                    }
+                    for host_domain in self.slots
+                },
+            }
+
+
+ADMISSION = AdmissionController()
+
+
+def get_host_operations() -> dict[tuple, float]:
+    with ADMISSION.lock:
+        return {
+            (host_domain, state): counter[host_domain]
+            for host_domain in ADMISSION.slots
+            for state, counter in [
+                ("active", ADMISSION.active),
+                ("waiting", ADMISSION.waiting),
+            ]
+        }
+
+
+REGISTRY.register(
+    Gauge(
+        "host_operations",
+        "Create/remove operations running or waiting for a slot per challenge host.",
+        ("host", "state"),
+        callback=get_host_operations,
+    )
+)
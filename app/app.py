@@ -4,13 +4,31 @@ from secrets import token_hex
 
 from flask import Flask
 
+from app.cluster import LEADER, is_postgresql, startup_lock
+from app.config import MULTI_REPLICA
+from app.counters import COUNTERS
 from app.database import db
+from app.events import EVENTS
+from app.hosts import HOSTS
+from app.images import IMAGE_WARMER
+from app.jobs import DEPLOY_QUEUE
+from app.migrations import upgrade
+from app.monitor import MONITOR
+from app.pool import WARM_POOL
+from app.ports import rebuild_port_allocators, sync_host_ports
+from app.reaper import REAPER
+from app.reconciler import RECONCILER
 
 
 def create_app():
     app = Flask(__name__)
 
-    app.secret_key = token_hex()
+    # The replicas must sign the sessions with the same key
+    app.secret_key = getenv("SECRET_KEY", "").strip()
+    if not app.secret_key:
+        if MULTI_REPLICA:
+            raise RuntimeError("SECRET_KEY is required with MULTI_REPLICA.")
+        app.secret_key = token_hex()
     app.debug = getenv("DEBUG", "").strip().upper() in ["1", "TRUE"]
     app.logger.setLevel(logging.DEBUG)
 
@@ -26,6 +44,28 @@ def create_app():
 
     db.init_app(app)
     with app.app_context():
-        db.create_all()
+        if MULTI_REPLICA and not is_postgresql():
+            app.logger.warning(
+                "MULTI_REPLICA needs a PostgreSQL database, the replicas are not synchronized."
+            )
+        with startup_lock():
+            db.create_all()
+            upgrade()
+        rebuild_port_allocators()
+        COUNTERS.reconcile()
+
+    # The hosts are probed in the background, the app serves immediately
+    HOSTS.listeners.append(sync_host_ports)
+    HOSTS.listeners.append(lambda host_domain: IMAGE_WARMER.wakeup.set())
+    LEADER.start(app)
+    EVENTS.start(app)
+    HOSTS.start(app)
+    COUNTERS.start(app)
+    IMAGE_WARMER.start(app)
+    REAPER.start(app)
+    RECONCILER.start(app)
+    MONITOR.start(app)
+    DEPLOY_QUEUE.start(app)
+    WARM_POOL.start(app)
 
     return app
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+
+from flask import Flask
+from sqlalchemy import or_, text
+from sqlalchemy.exc import IntegrityError
+
+from app.config import LEADER_LEASE_TIME, MULTI_REPLICA, REPLICA_ID
+from app.database import db
+from app.models import Leases
+
+
+def get_lock_key(name: str) -> int:
+    return zlib.crc32(name.encode())
+
+
+def is_postgresql() -> bool:
+    return db.engine.dialect.name == "postgresql"
+
+
+@contextmanager
+def db_lock(name: str):
+    """
+    Transaction serialized across the replicas with a PostgreSQL advisory lock,
+    committed at the end of the block (rolled back on error). Other databases
+    cannot be shared by replicas, the block is only a transaction.
+    """
+    try:
+        if MULTI_REPLICA and is_postgresql():
+            db.session.execute(
+                text("SELECT pg_advisory_xact_lock(:key)"),
+                {"key": get_lock_key(name)},
+            )
+        yield
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+@contextmanager
+def startup_lock(name: str = "startup"):
+    """
+    Held by one replica at a time while it creates and migrates the schema, on its
+    own connection so that the commits of the migrations do not release it.
+    """
+    if not (MULTI_REPLICA and is_postgresql()):
+        yield
+        return
+
+    with db.engine.connect() as connection:
+        key = get_lock_key(name)
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": key})
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
+
+
+class LeaderElection:
+    """
+    Lease in DB held by one replica at a time, so that a single replica runs the
+    reaper, the reconciler, the docker events monitor and the warm pool. The lease
+    is renewed every `lease_time / 3` seconds, it is taken over by another replica
+    once it expires. Without MULTI_REPLICA the process is always the leader.
+    """
+
+    def __init__(
+        self,
+        name: str = "leader",
+        lease_time: int = LEADER_LEASE_TIME,
+        identity: str = REPLICA_ID,
+    ):
+        self.app = None
+        self.name = name
+        self.lease_time = lease_time
+        self.identity = identity
+        self.lock = Lock()
+        # Monotonic time until which this replica holds the lease
+        self.valid_until = 0.0
+        self.holder = None
+
+    def start(self, app: Flask) -> None:
+        """
+        Start the election thread, only with MULTI_REPLICA.
+        """
+        self.app = app
+        if MULTI_REPLICA:
+            Thread(target=self.run, name="leader-election", daemon=True).start()
+
+    @property
+    def is_leader(self) -> bool:
+        if not MULTI_REPLICA:
+            return True
+        with self.lock:
+            return time.monotonic() < self.valid_until
+
+    def acquire(self) -> bool:
+        """
+        Take or renew the lease, returns True if this replica holds it.
+        """
+        start = time.monotonic()
+        now = datetime.utcnow()
+        values = {
+            "holder": self.identity,
+            "expires_at": now + timedelta(seconds=self.lease_time),
+        }
+
+        # Only one replica can update the row of an expired lease
+        updated = Leases.query.filter(
+            Leases.name == self.name,
+            or_(Leases.holder == self.identity, Leases.expires_at < now),
+        ).update(values, synchronize_session=False)
+        if not updated and db.session.get(Leases, self.name) is None:
+            db.session.add(Leases(name=self.name, **values))
+            updated = 1
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            updated = 0
+
+        lease = db.session.get(Leases, self.name)
+        db.session.commit()
+
+        with self.lock:
+            was_leader = time.monotonic() < self.valid_until
+            # The clock of the other replicas may be late, stop before the lease ends
+            self.valid_until = start + self.lease_time * 2 / 3 if updated else 0.0
+            self.holder = lease.holder if lease else None
+
+        if updated and not was_leader:
+            self.app.logger.info("Replica '%s' is the leader.", self.identity)
+        elif was_leader and not updated:
+            self.app.logger.warning(
+                "Replica '%s' lost the leadership to '%s'.", self.identity, self.holder
+            )
+        return bool(updated)
+
+    def run(self) -> None:
+        while True:
+            with self.app.app_context():
+                try:
+                    self.acquire()
+                except Exception as err:
+                    self.app.logger.error("Unable to renew the leader lease: %s", err)
+                    db.session.rollback()
+            time.sleep(self.lease_time / 3)
+
+    def status(self) -> dict:
+        """
+        Returns the identity of the replica and of the leader.
+        """
+        with self.lock:
+            holder = self.holder
+        return {
+            "multi_replica": MULTI_REPLICA,
+            "replica": self.identity,
+            "leader": holder if MULTI_REPLICA else self.identity,
+            "is_leader": self.is_leader,
+        }
+
+
+LEADER = LeaderElection()
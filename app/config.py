@@ -1,26 +1,218 @@
 #!/usr/bin/env python3
+from dataclasses import dataclass
 from json import load
-from os import getenv
-
-from docker import DockerClient
+from os import getenv, getpid
+from socket import gethostname
+from types import MappingProxyType
+from typing import Mapping, Optional
 
 DEBUG = getenv("DEBUG", "").strip().upper() in ["1", "TRUE"]
 ADMIN_ONLY = getenv("ADMIN_ONLY", "").strip().upper() in ["1", "TRUE"]
+# Several replicas of the app share the database (behind a load balancer)
+MULTI_REPLICA = getenv("MULTI_REPLICA", "").strip().upper() in ["1", "TRUE"]
+REPLICA_ID = getenv("REPLICA_ID", "").strip() or f"{gethostname()}-{getpid()}"
+
+MEMORY_UNITS = {"b": 1, "k": 1024, "m": 1024**2, "g": 1024**3}
+
+
+def parse_memory(value) -> int:
+    """
+    Convert a docker memory limit (ex: 512m, 1g, 1024) to bytes.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, int):
+        return value
+
+    value = str(value).strip().lower()
+    if value and value[-1] in MEMORY_UNITS:
+        return int(float(value[:-1]) * MEMORY_UNITS[value[-1]])
+    return int(value)
+
+
+@dataclass(frozen=True)
+class ContainerTemplate:
+    """
+    Container of a challenge with the defaults of config.json resolved.
+    """
+
+    docker_image: str
+    command: Optional[str]
+    hostname: Optional[str]
+    ports: tuple[tuple[str, str], ...]
+    environment: Mapping[str, str]
+    tmpfs: Mapping[str, str]
+    mem_limit: int
+    privileged: bool
+    read_only: bool
+    cpu_period: Optional[int]
+    cpu_quota: Optional[int]
+    cap_add: tuple[str, ...]
+    cap_drop: tuple[str, ...]
+
+    @property
+    def cpus(self) -> float:
+        if not self.cpu_quota:
+            return 0.0
+        return self.cpu_quota / (self.cpu_period or 100000)
+
+    def run_options(self) -> dict:
+        """
+        Returns the static arguments of `containers.run`, as fresh mutable copies.
+        """
+        return {
+            "image": self.docker_image,
+            "command": self.command,
+            "tmpfs": dict(self.tmpfs),
+            "mem_limit": self.mem_limit,
+            "privileged": self.privileged,
+            "read_only": self.read_only,
+            "cpu_period": self.cpu_period,
+            "cpu_quota": self.cpu_quota,
+            "cap_add": list(self.cap_add),
+            "cap_drop": list(self.cap_drop),
+        }
+
+
+@dataclass(frozen=True)
+class ChallengeTemplate:
+    """
+    Challenge of config.json compiled at startup.
+    """
+
+    name: str
+    containers: tuple[ContainerTemplate, ...]
+    warm_pool: int
+    images: frozenset[str]
+    ports_count: int
+    resources: Mapping[str, float]
+
+
+def compile_container(challenge_name: str, container: dict) -> ContainerTemplate:
+    """
+    Validate a container of config.json and resolve its defaults.
+    """
+    if not isinstance(container.get("docker_image"), str):
+        raise ValueError(f"Challenge '{challenge_name}': a container has no image.")
+
+    try:
+        ports = tuple(
+            (str(pinfo["port"]), str(pinfo["protocol"]))
+            for pinfo in container.get("ports", [])
+        )
+        mem_limit = parse_memory(container.get("mem_limit", "512m"))
+    except (KeyError, TypeError, ValueError) as err:
+        raise ValueError(
+            f"Challenge '{challenge_name}': invalid container '{container['docker_image']}' ({err})."
+        ) from err
+
+    for key in ["cpu_period", "cpu_quota"]:
+        if not isinstance(container.get(key) or 0, int):
+            raise ValueError(
+                f"Challenge '{challenge_name}': '{key}' must be an integer."
+            )
+
+    return ContainerTemplate(
+        docker_image=container["docker_image"],
+        command=container.get("command", None),
+        hostname=container.get("hostname", None),
+        ports=ports,
+        environment=MappingProxyType(
+            {str(k): str(v) for k, v in container.get("environment", {}).items()}
+        ),
+        tmpfs=MappingProxyType(dict(container.get("tmpfs", {}))),
+        mem_limit=mem_limit,
+        privileged=bool(container.get("privileged", False)),
+        read_only=bool(container.get("read_only", False)),
+        cpu_period=container.get("cpu_period", None),
+        cpu_quota=container.get("cpu_quota", None),
+        cap_add=tuple(container.get("cap_add", [])),
+        cap_drop=tuple(container.get("cap_drop", [])),
+    )
+
+
+def compile_challenges(challenges: list[dict]) -> tuple[ChallengeTemplate, ...]:
+    """
+    Compile the challenges of config.json, raises ValueError on an invalid config.
+    """
+    compiled = {}
+    for challenge in challenges:
+        name = challenge.get("name")
+        if not name or name in compiled:
+            raise ValueError(f"Invalid or duplicated challenge name '{name}'.")
+        if not challenge.get("containers"):
+            raise ValueError(f"Challenge '{name}' has no container.")
+
+        containers = tuple(
+            compile_container(name, container) for container in challenge["containers"]
+        )
+        compiled[name] = ChallengeTemplate(
+            name=name,
+            containers=containers,
+            warm_pool=int(challenge.get("warm_pool", 0)),
+            images=frozenset(container.docker_image for container in containers),
+            ports_count=sum(len(container.ports) for container in containers),
+            resources=MappingProxyType(
+                {
+                    "instances": len(containers),
+                    "memory": sum(container.mem_limit for container in containers),
+                    "cpus": sum(container.cpus for container in containers),
+                }
+            ),
+        )
+    return tuple(compiled.values())
+
 
 with open("config.json", "r") as config_file:
     config = load(config_file)
 
     WEBSITE_TITLE = config["website_title"]
     CTFD_URL = config["ctfd_url"].rstrip("/")
+    CTFD_TIMEOUT = config.get("ctfd_timeout", 5)
+    CTFD_POOL_SIZE = config.get("ctfd_pool_size", 16)
+    CTFD_CACHE_TTL = config.get("ctfd_cache_ttl", 300)
 
     MAX_INSTANCE_COUNT = config["max_instance_count"]
     MAX_INSTANCE_DURATION = config["max_instance_duration"]
     MAX_INSTANCE_PER_TEAM = config["max_instance_per_team"]
+    INSTANCE_EXTENSION = config.get("instance_extension", MAX_INSTANCE_DURATION)
+    MAX_INSTANCE_EXTENSIONS = config.get("max_instance_extensions", 1)
     MIN_PORTS = config["random_ports"]["min"]
     MAX_PORTS = config["random_ports"]["max"]
+    PLACEMENT_STRATEGY = config.get("placement", "least_loaded")
+    DEPLOY_THREADS = config.get("deploy_threads", 8)
+    DEPLOY_WORKERS = config.get("deploy_workers", 4)
+    DEPLOY_QUEUE_SIZE = config.get("deploy_queue_size", 100)
+    REAPER_INTERVAL = config.get("reaper_interval", 5)
+    WARM_POOL_INTERVAL = config.get("warm_pool_interval", 10)
+    IMAGE_PULL_INTERVAL = config.get("image_pull_interval", 300)
+    TEARDOWN_THREADS = config.get("teardown_threads", 4)
+    COUNTERS_RECONCILE_INTERVAL = config.get("counters_reconcile_interval", 60)
+    WEB_THREADS = config.get("web_threads", 16)
+    METRICS_TOKEN = config.get("metrics_token", "")
+    EVENTS_BUFFER_SIZE = config.get("events_buffer_size", 1000)
+    EVENTS_RETRY_INTERVAL = config.get("events_retry_interval", 2)
+    EVENTS_POLL_INTERVAL = config.get("events_poll_interval", 1)
+    DOCKER_CONNECT_TIMEOUT = config.get("docker_connect_timeout", 3)
+    DOCKER_READ_TIMEOUT = config.get("docker_read_timeout", 30)
+    DOCKER_POOL_SIZE = config.get("docker_pool_size", DEPLOY_THREADS + TEARDOWN_THREADS)
+    HOST_CHECK_INTERVAL = config.get("host_check_interval", 10)
+    HOST_FAILURE_THRESHOLD = config.get("host_failure_threshold", 3)
+    HOST_RECOVERY_TIME = config.get("host_recovery_time", 30)
+    RECONCILE_INTERVAL = config.get("reconcile_interval", 60)
+    RECONCILE_GRACE = config.get("reconcile_grace", 120)
+    DOCKER_EVENTS_WINDOW = config.get("docker_events_window", 60)
+    DOCKER_EVENTS_MAX_BACKOFF = config.get("docker_events_max_backoff", 60)
+    # Deployments per minute (0 disables the limit)
+    ADMISSION_USER_RATE = config.get("admission_user_rate", 4)
+    ADMISSION_USER_BURST = config.get("admission_user_burst", 2)
+    ADMISSION_TEAM_RATE = config.get("admission_team_rate", 12)
+    ADMISSION_TEAM_BURST = config.get("admission_team_burst", 6)
+    HOST_MAX_OPERATIONS = config.get("host_max_operations", DEPLOY_THREADS)
+    LEADER_LEASE_TIME = config.get("leader_lease_time", 15)
 
-    CHALLENGES = config["challenges"]
+    CHALLENGES = compile_challenges(config["challenges"])
+    CHALLENGES_CATALOG = MappingProxyType(
+        {challenge.name: challenge for challenge in CHALLENGES}
+    )
     DOCKER_HOSTS = config["hosts"]
-
-    for host in DOCKER_HOSTS:
-        host["client"] = DockerClient(base_url=host["api"])
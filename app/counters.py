@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+from typing import Iterator, Optional
+
+from flask import Flask
+from sqlalchemy import func
+
+from app.cluster import db_lock
+from app.config import (
+    CHALLENGES_CATALOG,
+    COUNTERS_RECONCILE_INTERVAL,
+    MAX_INSTANCE_COUNT,
+    MAX_INSTANCE_PER_TEAM,
+    MULTI_REPLICA,
+    REPLICA_ID,
+)
+from app.database import db
+from app.metrics import REGISTRY, Gauge
+from app.models import Deployments, Instances, Reservations
+
+# Lifetime of a reservation shared in DB, in case its replica stops
+RESERVATION_TIMEOUT = timedelta(minutes=10)
+# Snapshots taken per reconcile run before giving up until the next run
+RECONCILE_ATTEMPTS = 3
+
+
+class Reservation:
+    """
+    Capacity (one team slot and the containers of a challenge) held by a deployment
+    that is not yet saved in DB.
+    """
+
+    def __init__(self, team_id: int, instances: int):
+        self.team_id = team_id
+        self.instances = instances
+        self.active = True
+        # Row of the reservation in DB (MULTI_REPLICA)
+        self.claim_id = None
+
+
+class InstanceCounters:
+    """
+    Live counts of the deployments (global, per team and per host), updated after
+    each commit and reconciled periodically against the Deployments table.
+    """
+
+    def __init__(self, interval: int = COUNTERS_RECONCILE_INTERVAL):
+        self.app = None
+        self.interval = interval
+        self.wakeup = Event()
+        self.lock = Lock()
+
+        self.instances = 0
+        self.team_deployments = Counter()
+        self.team_instances = Counter()
+        # {(host_domain, challenge_name): deployments}
+        self.host_deployments = Counter()
+
+        self.pending_instances = 0
+        self.pending_teams = Counter()
+        # Incremented by each change of the live counts, `changes` is the number
+        # of commits whose counts are not updated yet
+        self.generation = 0
+        self.changes = 0
+        self.last_reconcile = None
+        self.last_drift = 0
+
+    def start(self, app: Flask) -> None:
+        """
+        Start the reconcile thread.
+        """
+        self.app = app
+        Thread(target=self.run, name="counters", daemon=True).start()
+
+    @property
+    def total(self) -> int:
+        """
+        Number of running containers, reservations included.
+        """
+        with self.lock:
+            return self.instances + self.pending_instances
+
+    def team_count(self, team_id: int) -> int:
+        """
+        Number of deployments of a team, reservations included.
+        """
+        with self.lock:
+            return self.team_deployments[team_id] + self.pending_teams[team_id]
+
+    def team_instance_count(self, team_id: int) -> int:
+        """
+        Number of running containers of a team.
+        """
+        with self.lock:
+            return self.team_instances[team_id]
+
+    def reserve(
+        self, team_id: int, instances: int
+    ) -> tuple[Optional[Reservation], str]:
+        """
+        Check the team and global quotas and hold the capacity in a single step,
+        `instances` is 0 to only hold a slot of the team. Returns None and the
+        reason if a quota is reached.
+        """
+        if MULTI_REPLICA:
+            return self.reserve_shared(team_id, instances)
+
+        with self.lock:
+            if (
+                self.team_deployments[team_id] + self.pending_teams[team_id]
+                >= MAX_INSTANCE_PER_TEAM
+            ):
+                return (
+                    None,
+                    f"Your team has reached the maximum number of concurrent running instances ({MAX_INSTANCE_PER_TEAM}).",
+                )
+
+            if self.instances + self.pending_instances + instances > MAX_INSTANCE_COUNT:
+                return (
+                    None,
+                    f"The maximum number of dynamic instances has been reached (max: {MAX_INSTANCE_COUNT}).",
+                )
+
+            self.pending_teams[team_id] += 1
+            self.pending_instances += instances
+            return Reservation(team_id, instances), ""
+
+    def reserve_shared(
+        self, team_id: int, instances: int
+    ) -> tuple[Optional[Reservation], str]:
+        """
+        Multi-replica variant of `reserve`: the quotas are checked against the DB,
+        where the reservations of every replica are saved, under a lock shared by
+        the replicas.
+        """
+        now = datetime.utcnow()
+        with db_lock("quotas"):
+            reservations = Reservations.query.filter(Reservations.expires_at > now)
+            team_deployments = (
+                Deployments.query.filter_by(team_id=team_id).count()
+                + reservations.filter_by(team_id=team_id).count()
+            )
+            if team_deployments >= MAX_INSTANCE_PER_TEAM:
+                return (
+                    None,
+                    f"Your team has reached the maximum number of concurrent running instances ({MAX_INSTANCE_PER_TEAM}).",
+                )
+
+            total = db.session.query(func.count(Instances.id)).scalar() + (
+                db.session.query(func.coalesce(func.sum(Reservations.instances), 0))
+                .filter(Reservations.expires_at > now)
+                .scalar()
+            )
+            if total + instances > MAX_INSTANCE_COUNT:
+                return (
+                    None,
+                    f"The maximum number of dynamic instances has been reached (max: {MAX_INSTANCE_COUNT}).",
+                )
+
+            claim = Reservations(
+                team_id=team_id,
+                instances=instances,
+                replica=REPLICA_ID,
+                expires_at=now + RESERVATION_TIMEOUT,
+            )
+            db.session.add(claim)
+            db.session.flush()
+            claim_id = claim.id
+
+        reservation = Reservation(team_id, instances)
+        reservation.claim_id = claim_id
+        with self.lock:
+            self.pending_teams[team_id] += 1
+            self.pending_instances += instances
+        return reservation, ""
+
+    def drop_claim(self, reservation: Optional[Reservation]) -> None:
+        """
+        Delete the row of a shared reservation, a leftover row expires anyway.
+        """
+        if reservation is None or reservation.claim_id is None:
+            return
+
+        claim_id, reservation.claim_id = reservation.claim_id, None
+        try:
+            Reservations.query.filter_by(id=claim_id).delete()
+            db.session.commit()
+        except Exception as err:
+            db.session.rollback()
+            if self.app:
+                self.app.logger.warning(
+                    "Unable to delete the reservation n°%d: %s", claim_id, err
+                )
+
+    def release(self, reservation: Optional[Reservation]) -> None:
+        """
+        Give back the capacity of a reservation (no-op once used or released).
+        """
+        with self.lock:
+            self._release(reservation)
+        self.drop_claim(reservation)
+
+    def _release(self, reservation: Optional[Reservation]) -> None:
+        if reservation is None or not reservation.active:
+            return
+        reservation.active = False
+        self.pending_teams[reservation.team_id] -= 1
+        if self.pending_teams[reservation.team_id] <= 0:
+            del self.pending_teams[reservation.team_id]
+        self.pending_instances -= reservation.instances
+
+    def add(
+        self,
+        team_id: int,
+        host_domain: str,
+        challenge_name: str,
+        instances: int,
+        reservation: Optional[Reservation] = None,
+    ) -> None:
+        """
+        Count a deployment once committed, its reservation becomes live.
+        """
+        with self.lock:
+            self._release(reservation)
+            self.generation += 1
+            self.instances += instances
+            self.team_deployments[team_id] += 1
+            self.team_instances[team_id] += instances
+            self.host_deployments[(host_domain, challenge_name)] += 1
+        self.drop_claim(reservation)
+
+    def remove(
+        self, team_id: int, host_domain: str, challenge_name: str, instances: int
+    ) -> None:
+        """
+        Forget a deployment once its deletion is committed.
+        """
+        with self.lock:
+            self.generation += 1
+            self.instances = max(self.instances - instances, 0)
+            self.team_deployments[team_id] -= 1
+            self.team_instances[team_id] -= instances
+            self.host_deployments[(host_domain, challenge_name)] -= 1
+            # Drop the zero (or drifted) entries
+            self.team_deployments = +self.team_deployments
+            self.team_instances = +self.team_instances
+            self.host_deployments = +self.host_deployments
+
+    def move(
+        self,
+        from_team_id: int,
+        to_team_id: int,
+        instances: int,
+        reservation: Optional[Reservation] = None,
+    ) -> None:
+        """
+        Count a deployment claimed from the warm pool for another team.
+        """
+        with self.lock:
+            self.generation += 1
+            self._release(reservation)
+            self.team_deployments[from_team_id] -= 1
+            self.team_instances[from_team_id] -= instances
+            self.team_deployments[to_team_id] += 1
+            self.team_instances[to_team_id] += instances
+            self.team_deployments = +self.team_deployments
+            self.team_instances = +self.team_instances
+        self.drop_claim(reservation)
+
+    @contextmanager
+    def changing(self) -> Iterator[None]:
+        """
+        Wrap a commit of the Deployments table and the update of the counts that
+        follows it, a reconcile running meanwhile is not applied.
+        """
+        with self.lock:
+            self.generation += 1
+            self.changes += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.generation += 1
+                self.changes -= 1
+
+    def get_host_deployments(self) -> dict[tuple[str, str], int]:
+        """
+        Returns the number of deployments of each challenge on each host.
+        """
+        with self.lock:
+            return dict(self.host_deployments)
+
+    def reconcile(self) -> bool:
+        """
+        Recompute the live counts from the Deployments table. The snapshot is not
+        applied if a deployment was committed but not counted yet, or changed during
+        the query, returns False in that case.
+        """
+        with self.lock:
+            if self.changes:
+                return False
+            generation = self.generation
+        rows = (
+            db.session.query(
+                Deployments.team_id,
+                Deployments.host_domain,
+                Deployments.challenge_name,
+                func.count(func.distinct(Deployments.id)),
+                func.count(Instances.id),
+            )
+            .outerjoin(Instances)
+            .group_by(
+                Deployments.team_id, Deployments.host_domain, Deployments.challenge_name
+            )
+            .all()
+        )
+        db.session.commit()
+
+        instances = 0
+        team_deployments, team_instances = Counter(), Counter()
+        host_deployments = Counter()
+        for team_id, host_domain, challenge_name, deployments, containers in rows:
+            instances += containers
+            team_deployments[team_id] += deployments
+            team_instances[team_id] += containers
+            host_deployments[(host_domain, challenge_name)] += deployments
+
+        with self.lock:
+            if self.changes or self.generation != generation:
+                return False
+            self.last_drift = instances - self.instances
+            self.instances = instances
+            self.team_deployments = team_deployments
+            self.team_instances = team_instances
+            self.host_deployments = host_deployments
+            self.last_reconcile = datetime.utcnow()
+        return True
+
+    def run(self) -> None:
+        while True:
+            with self.app.app_context():
+                try:
+                    # Retried shortly if the counts changed during the query
+                    for attempt in range(RECONCILE_ATTEMPTS):
+                        if self.reconcile():
+                            break
+                        time.sleep(attempt + 1)
+                except Exception as err:
+                    self.app.logger.error("Unable to reconcile the counters: %s", err)
+                    db.session.rollback()
+
+            self.wakeup.wait(timeout=self.interval)
+            self.wakeup.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the live counts and the drift found by the last reconcile.
+        """
+        with self.lock:
+            return {
+                "instances": self.instances,
+                "deployments": sum(self.team_deployments.values()),
+                "pending_instances": self.pending_instances,
+                "pending_deployments": sum(self.pending_teams.values()),
+                "last_drift": self.last_drift,
+                "last_reconcile": self.last_reconcile,
+            }
+
+
+COUNTERS = InstanceCounters()
+
+
+def get_host_instances() -> dict[tuple, int]:
+    host_instances = Counter()
+    host_deployments = COUNTERS.get_host_deployments()
+    for (host_domain, challenge_name), deployments in host_deployments.items():
+        challenge = CHALLENGES_CATALOG.get(challenge_name)
+        if challenge is not None:
+            host_instances[(host_domain,)] += (
+                deployments * challenge.resources["instances"]
+            )
+    return dict(host_instances)
+
+
+def get_team_deployments() -> dict[tuple, int]:
+    with COUNTERS.lock:
+        return {
+            (team_id,): count for team_id, count in COUNTERS.team_deployments.items()
+        }
+
+
+REGISTRY.register(
+    Gauge(
+        "live_instances",
+        "Running containers per challenge host.",
+        ("host",),
+        callback=get_host_instances,
+    )
+)
+REGISTRY.register(
+    Gauge(
+        "live_deployments",
+        "Running deployments per team (team 0 is the warm pool).",
+        ("team_id",),
+        callback=get_team_deployments,
+    )
+)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.config import CTFD_CACHE_TTL, CTFD_POOL_SIZE, CTFD_TIMEOUT, CTFD_URL
+from app.metrics import CTFD_API_ERRORS, CTFD_API_SECONDS
+
+
+class TTLCache:
+    """
+    Thread-safe dictionary whose entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, ttl: int, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.data = {}
+        self.lock = Lock()
+
+    def get(self, key: Any) -> Optional[Any]:
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.data[key]
+                return None
+            return entry[1]
+
+    def set(self, key: Any, value: Any) -> None:
+        with self.lock:
+            if len(self.data) >= self.maxsize:
+                now = time.monotonic()
+                self.data = {k: v for k, v in self.data.items() if v[0] >= now}
+                if len(self.data) >= self.maxsize:
+                    self.data.pop(next(iter(self.data)))
+            self.data[key] = (time.monotonic() + self.ttl, value)
+
+
+class CTFdClient:
+    """
+    CTFd API client sharing a pool of keep-alive connections between threads.
+    """
+
+    def __init__(
+        self,
+        base_url: str = CTFD_URL,
+        timeout: float = CTFD_TIMEOUT,
+        pool_size: int = CTFD_POOL_SIZE,
+        cache_ttl: int = CTFD_CACHE_TTL,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix="ctfd"
+        )
+
+        self.identities = TTLCache(cache_ttl)
+        self.team_names = TTLCache(cache_ttl)
+
+    def get(self, path: str, key: str, endpoint: str) -> dict:
+        """
+        GET an endpoint of the CTFd API with the access key of a user, `endpoint`
+        names the call in the metrics.
+        """
+        try:
+            with CTFD_API_SECONDS.time(endpoint=endpoint):
+                return self.session.get(
+                    f"{self.base_url}{path}",
+                    headers={
+                        "Authorization": f"Token {key}",
+                        "Content-Type": "application/json",
+                    },
+                    timeout=self.timeout,
+                ).json()
+        except Exception:
+            CTFD_API_ERRORS.inc(endpoint=endpoint)
+            raise
+
+    def get_team_name(self, key: str, team_id: int) -> str:
+        team_name = self.team_names.get(team_id)
+        if team_name is None:
+            resp_json = self.get(f"/api/v1/teams/{team_id}", key, "teams")
+            team_name = resp_json.get("data", {}).get("name", "")
+            self.team_names.set(team_id, team_name)
+        return team_name
+
+    def is_admin(self, key: str) -> bool:
+        return self.get("/api/v1/configs", key, "configs").get("success", False)
+
+    def get_identity(self, key: str) -> tuple[bool, str, dict]:
+        """
+        Returns the user_id, username, team_id, team_name and is_admin of an access key.
+        """
+        token_hash = hashlib.sha256(key.encode()).hexdigest()
+        identity = self.identities.get(token_hash)
+        if identity is not None:
+            return True, "", dict(identity)
+
+        user = {
+            "user_id": None,
+            "username": None,
+            "team_id": None,
+            "team_name": None,
+            "is_admin": False,
+        }
+
+        resp_json = self.get("/api/v1/users/me", key, "users_me")
+        success = resp_json.get("success", False)
+        user["user_id"] = resp_json.get("data", {}).get("id", "")
+        user["username"] = resp_json.get("data", {}).get("name", "")
+        user["team_id"] = resp_json.get("data", {}).get("team_id", False)
+
+        # User is not in a team
+        if not success or not user["team_id"]:
+            return False, "User not in a team or invalid token.", user
+
+        team_name = self.executor.submit(self.get_team_name, key, user["team_id"])
+        is_admin = self.executor.submit(self.is_admin, key)
+        user["team_name"] = team_name.result()
+        user["is_admin"] = is_admin.result()
+
+        self.identities.set(token_hash, dict(user))
+        return True, "", user
+
+
+CTFD_CLIENT = CTFdClient()
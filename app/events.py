@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+import json
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from threading import Condition, Thread
+from typing import Iterator, Optional
+
+from flask import Flask
+from sqlalchemy import func
+
+from app.cluster import LEADER
+from app.config import (
+    EVENTS_BUFFER_SIZE,
+    EVENTS_POLL_INTERVAL,
+    EVENTS_RETRY_INTERVAL,
+    MULTI_REPLICA,
+)
+from app.database import db
+from app.models import Events
+
+# Shared events read again at each poll: a row can be committed after a row with
+# a greater ID (concurrent transactions)
+POLL_WINDOW = 100
+# Age of the shared events deleted by the leader replica
+EVENTS_RETENTION = timedelta(minutes=10)
+
+
+class EventBus:
+    """
+    Fan-out of the deployment lifecycle events (starting, ready, failed, expiring,
+    removed) to Server-Sent Events streams.
+
+    Publishers only append to a ring buffer, they never block on a slow client.
+    A stream never waits for new events: it sends the buffered events after the
+    cursor of the browser and is closed at once, so that no web thread is held.
+    The browser reconnects after `retry` seconds with Last-Event-ID.
+
+    With MULTI_REPLICA, the events are saved in DB and each replica polls them
+    into its own buffer, so that the streams of every replica get the events of
+    the threads running on the leader (reaper, reconciler, docker events).
+    """
+
+    def __init__(
+        self,
+        size: int = EVENTS_BUFFER_SIZE,
+        retry: float = EVENTS_RETRY_INTERVAL,
+        poll_interval: float = EVENTS_POLL_INTERVAL,
+        shared: bool = MULTI_REPLICA,
+    ):
+        self.app = None
+        self.events = deque(maxlen=size)
+        self.last_id = 0
+        self.retry = retry
+        self.condition = Condition()
+
+        self.shared = shared
+        self.poll_interval = poll_interval
+        # Highest ID of the shared events and the IDs read in the last window
+        self.synced_id = 0
+        self.synced_ids = set()
+        self.last_prune = 0.0
+
+    def start(self, app: Flask) -> None:
+        """
+        Start the thread polling the shared events, only with MULTI_REPLICA.
+        """
+        self.app = app
+        if not self.shared:
+            return
+
+        with app.app_context():
+            self.synced_id = db.session.query(func.max(Events.id)).scalar() or 0
+            self.synced_ids = {
+                event_id
+                for (event_id,) in db.session.query(Events.id).filter(
+                    Events.id > self.synced_id - POLL_WINDOW
+                )
+            }
+            db.session.commit()
+        Thread(target=self.run, name="events", daemon=True).start()
+
+    def publish(self, event_type: str, team_id: int, **data) -> None:
+        if self.shared and self.app is not None:
+            try:
+                self.save(event_type, team_id, data)
+                return
+            except Exception as err:
+                self.app.logger.error(
+                    "Unable to share the event '%s': %s", event_type, err
+                )
+        self.append(event_type, team_id, data)
+
+    def save(self, event_type: str, team_id: int, data: dict) -> None:
+        """
+        Save a shared event, in its own app context so that the transaction of the
+        caller is left untouched.
+        """
+        with self.app.app_context():
+            try:
+                db.session.add(
+                    Events(
+                        type=event_type,
+                        team_id=team_id,
+                        data=json.dumps(data, default=str),
+                    )
+                )
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def sync(self) -> None:
+        """
+        Append the shared events saved since the last poll to the buffer.
+        """
+        rows = (
+            Events.query.filter(Events.id > self.synced_id - POLL_WINDOW)
+            .order_by(Events.id)
+            .all()
+        )
+        db.session.commit()
+
+        for row in rows:
+            if row.id in self.synced_ids:
+                continue
+            self.synced_ids.add(row.id)
+            self.synced_id = max(self.synced_id, row.id)
+            self.append(row.type, row.team_id, json.loads(row.data))
+
+        self.synced_ids = {
+            event_id
+            for event_id in self.synced_ids
+            if event_id > self.synced_id - POLL_WINDOW
+        }
+
+        # Only the leader replica deletes the old events, once per minute
+        if LEADER.is_leader and time.monotonic() - self.last_prune > 60:
+            self.last_prune = time.monotonic()
+            Events.query.filter(
+                Events.creation_date < datetime.utcnow() - EVENTS_RETENTION
+            ).delete(synchronize_session=False)
+            db.session.commit()
+
+    def run(self) -> None:
+        while True:
+            with self.app.app_context():
+                try:
+                    self.sync()
+                except Exception as err:
+                    self.app.logger.error("Unable to poll the shared events: %s", err)
+                    db.session.rollback()
+            time.sleep(self.poll_interval)
+
+    def append(self, event_type: str, team_id: int, data: dict) -> None:
+        with self.condition:
+            self.last_id += 1
+            self.events.append(
+                {
+                    "id": self.last_id,
+                    "type": event_type,
+                    "team_id": team_id,
+                    "data": dict(data, team_id=team_id),
+                }
+            )
+            self.condition.notify_all()
+
+    @staticmethod
+    def format(event: dict) -> str:
+        return (
+            f"id: {event['id']}\n"
+            f"event: {event['type']}\n"
+            f"data: {json.dumps(event['data'], default=str)}\n\n"
+        )
+
+    def stream(
+        self, last_id: Optional[int] = None, team_id: Optional[int] = None
+    ) -> Iterator[str]:
+        """
+        Send the buffered events after `last_id` (all teams if `team_id` is None),
+        then close the stream.
+        """
+        yield f"retry: {int(self.retry * 1000)}\n\n"
+
+        with self.condition:
+            oldest = self.events[0]["id"] if self.events else self.last_id + 1
+            # The server restarted or the events were dropped from the buffer
+            lost = last_id is not None and not oldest - 1 <= last_id <= self.last_id
+            cursor = self.last_id if last_id is None or lost else last_id
+            events = [event for event in self.events if event["id"] > cursor]
+
+        if lost:
+            yield self.format({"id": cursor, "type": "reset", "data": {}})
+
+        for event in events:
+            cursor = event["id"]
+            if team_id is None or event["team_id"] == team_id:
+                yield self.format(event)
+
+        # Move the Last-Event-ID of the browser past the filtered events
+        yield f"id: {cursor}\n\n"
+
+
+EVENTS = EventBus()
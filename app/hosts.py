@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Event, Lock, Thread
+from typing import Callable
+
+import requests
+from docker import DockerClient
+from docker.errors import APIError, DockerException, NotFound
+from flask import Flask
+
+from app.config import (
+    DOCKER_CONNECT_TIMEOUT,
+    DOCKER_HOSTS,
+    DOCKER_POOL_SIZE,
+    DOCKER_READ_TIMEOUT,
+    HOST_CHECK_INTERVAL,
+    HOST_FAILURE_THRESHOLD,
+    HOST_RECOVERY_TIME,
+)
+from app.metrics import REGISTRY, Gauge, docker_call
+
+# Server errors of the daemon caused by the request, not by the health of the host
+REQUEST_ERRORS = (
+    "port is already allocated",
+    "address already in use",
+    "non-overlapping ipv4 address pool",
+    "has active endpoints",
+)
+
+
+def is_host_failure(err: Exception) -> bool:
+    """
+    Returns True if the error means the host is unhealthy (unreachable, timeout,
+    daemon error), not that the request itself was invalid.
+    """
+    # Missing container, network or image
+    if isinstance(err, NotFound):
+        return False
+    if isinstance(err, APIError):
+        if err.response is None:
+            return True
+        return err.is_server_error() and not any(
+            message in str(err.explanation or err).lower() for message in REQUEST_ERRORS
+        )
+    # Raised by docker-py when the API version of the daemon cannot be fetched
+    return isinstance(err, (requests.RequestException, DockerException))
+
+
+def create_client(docker_host: dict) -> DockerClient:
+    """
+    Docker client with bounded connect/read timeouts and a connection pool shared
+    by the deploy and teardown threads.
+    """
+    # The constructor fetches the API version of the daemon
+    client = DockerClient(
+        base_url=docker_host["api"],
+        timeout=DOCKER_CONNECT_TIMEOUT,
+        max_pool_size=DOCKER_POOL_SIZE,
+    )
+    # The TCP adapter of docker-py keeps the default pool of requests (10)
+    if docker_host["api"].startswith(("tcp://", "http://")):
+        client.api.mount(
+            "http://", requests.adapters.HTTPAdapter(pool_maxsize=DOCKER_POOL_SIZE)
+        )
+    client.api.timeout = (DOCKER_CONNECT_TIMEOUT, DOCKER_READ_TIMEOUT)
+    return client
+
+
+class LazyDockerClient:
+    """
+    Connect to a challenge host on first use, so that a slow or unreachable host
+    does not delay the startup. A failed connection is retried on the next use.
+    """
+
+    def __init__(self, docker_host: dict):
+        self.docker_host = docker_host
+        self.client = None
+        self.lock = Lock()
+
+    def connect(self) -> DockerClient:
+        with self.lock:
+            if self.client is None:
+                self.client = create_client(self.docker_host)
+            return self.client
+
+    @property
+    def connected(self) -> bool:
+        return self.client is not None
+
+    def __getattr__(self, name: str):
+        return getattr(self.connect(), name)
+
+
+class HostHealth:
+    """
+    Circuit breaker of a challenge host: unknown (not probed yet), closed (healthy),
+    open (excluded from the placement) or half-open (recovery time elapsed, waiting
+    for a successful ping).
+    """
+
+    def __init__(self):
+        self.state = "unknown"
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = None
+        self.last_check = None
+        self.latency = None
+
+    def to_dict(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opened_at": self.opened_at,
+            "last_error": self.last_error,
+            "last_check": self.last_check,
+            "latency": self.latency,
+        }
+
+
+class DockerHostManager:
+    """
+    Docker clients of the challenge hosts and their health. A host failing
+    `failure_threshold` times in a row is skipped by the placement, the teardown
+    and the image warmer for `recovery_time` seconds, then until a ping succeeds.
+    """
+
+    def __init__(
+        self,
+        hosts: list[dict] = DOCKER_HOSTS,
+        interval: int = HOST_CHECK_INTERVAL,
+        failure_threshold: int = HOST_FAILURE_THRESHOLD,
+        recovery_time: int = HOST_RECOVERY_TIME,
+    ):
+        self.app = None
+        self.hosts = hosts
+        self.interval = interval
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.health = {docker_host["domain"]: HostHealth() for docker_host in hosts}
+        self.lock = Lock()
+        self.wakeup = Event()
+        # Set once every host was probed at least once
+        self.probed = Event()
+        # Called with the domain of a host when it becomes available
+        self.listeners: list[Callable[[str], None]] = []
+
+        for docker_host in hosts:
+            docker_host["client"] = LazyDockerClient(docker_host)
+
+    def start(self, app: Flask) -> None:
+        """
+        Start the health check thread, the hosts are probed in the background.
+        """
+        self.app = app
+        Thread(target=self.run, name="host-checker", daemon=True).start()
+
+    def is_available(self, host_domain: str) -> bool:
+        """
+        Returns True if new deployments can be placed on the host.
+        """
+        with self.lock:
+            health = self.health.get(host_domain)
+            return health is not None and health.state == "closed"
+
+    def is_down(self, host_domain: str) -> bool:
+        """
+        Returns True while the circuit of the host is open.
+        """
+        with self.lock:
+            health = self.health.get(host_domain)
+            return health is None or health.state == "open"
+
+    def get_available_hosts(self) -> list[dict]:
+        return [
+            docker_host
+            for docker_host in self.hosts
+            if self.is_available(docker_host["domain"])
+        ]
+
+    def record_success(self, host_domain: str) -> None:
+        """
+        Reset the failures of a healthy host, only the health check makes a host
+        available again.
+        """
+        with self.lock:
+            health = self.health[host_domain]
+            if health.state == "closed":
+                health.failures = 0
+
+    def mark_available(self, host_domain: str) -> None:
+        """
+        Close the circuit of a host once its listeners (ports sync, image pulls)
+        are done, a failing listener keeps the host unavailable.
+        """
+        with self.lock:
+            health = self.health[host_domain]
+            if health.state == "closed":
+                health.failures = 0
+                return
+
+        for listener in self.listeners:
+            try:
+                listener(host_domain)
+            except Exception as err:
+                self.record_failure(host_domain, err)
+                return
+
+        with self.lock:
+            health.state = "closed"
+            health.failures = 0
+            health.opened_at = None
+        if self.app:
+            self.app.logger.info("Challenge host '%s' is available.", host_domain)
+
+    def record_failure(self, host_domain: str, err: Exception) -> None:
+        with self.lock:
+            health = self.health[host_domain]
+            health.failures += 1
+            health.last_error = str(err)
+            if health.state != "open" and (
+                health.state in ["unknown", "half-open"]
+                or health.failures >= self.failure_threshold
+            ):
+                health.state = "open"
+                health.opened_at = datetime.utcnow()
+                if self.app:
+                    self.app.logger.error(
+                        "Challenge host '%s' is unavailable after %d failures: %s",
+                        host_domain,
+                        health.failures,
+                        err,
+                    )
+
+    @contextmanager
+    def call(self, host_domain: str, operation: str):
+        """
+        Time a Docker API call and feed the circuit breaker of the host.
+        """
+        try:
+            with docker_call(host_domain, operation):
+                yield
+        except Exception as err:
+            if is_host_failure(err):
+                self.record_failure(host_domain, err)
+            raise
+        else:
+            self.record_success(host_domain)
+
+    def check(self, docker_host: dict) -> None:
+        """
+        Ping a host, an open circuit goes half-open once the recovery time elapsed.
+        """
+        host_domain = docker_host["domain"]
+        with self.lock:
+            health = self.health[host_domain]
+            if (
+                health.state == "open"
+                and (datetime.utcnow() - health.opened_at).total_seconds()
+                >= self.recovery_time
+            ):
+                health.state = "half-open"
+
+        start = time.perf_counter()
+        try:
+            with docker_call(host_domain, "ping"):
+                docker_host["client"].ping()
+        except Exception as err:
+            self.record_failure(host_domain, err)
+        else:
+            self.mark_available(host_domain)
+        finally:
+            with self.lock:
+                health.last_check = datetime.utcnow()
+                health.latency = round(time.perf_counter() - start, 3)
+
+    def check_all(self) -> None:
+        """
+        Ping every host in parallel, a slow host does not delay the others.
+        """
+        with ThreadPoolExecutor(
+            max_workers=max(len(self.hosts), 1), thread_name_prefix="host-checker"
+        ) as executor:
+            list(executor.map(self.check, self.hosts))
+        self.probed.set()
+
+    def run(self) -> None:
+        while True:
+            self.check_all()
+            self.wakeup.wait(timeout=self.interval)
+            self.wakeup.clear()
+
+    def status(self) -> dict:
+        """
+        Returns the health of every host.
+        """
+        with self.lock:
+            status = {
+                domain: health.to_dict() for domain, health in self.health.items()
+            }
+        for docker_host in self.hosts:
+            status[docker_host["domain"]]["connected"] = docker_host["client"].connected
+        return status
+
+
+HOSTS = DockerHostManager()
+
+
+def get_hosts_up() -> dict[tuple, float]:
+    return {
+        (host_domain,): int(health["state"] == "closed")
+        for host_domain, health in HOSTS.status().items()
+    }
+
+
+REGISTRY.register(
+    Gauge(
+        "docker_host_up",
+        "1 if the challenge host is available for new deployments (circuit closed).",
+        ("host",),
+        callback=get_hosts_up,
+    )
+)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import Event, Lock, Thread
+
+from docker.errors import ImageNotFound
+from flask import Flask
+
+from app.config import CHALLENGES, DOCKER_HOSTS, IMAGE_PULL_INTERVAL
+from app.hosts import HOSTS
+
+CHALLENGES_IMAGES = sorted(
+    {image for challenge in CHALLENGES for image in challenge.images}
+)
+
+
+class ImageWarmer:
+    """
+    Pull the images of every challenge on every host and cache their presence.
+    """
+
+    def __init__(self, interval: int = IMAGE_PULL_INTERVAL):
+        self.app = None
+        self.interval = interval
+        self.wakeup = Event()
+        self.lock = Lock()
+        # {host_domain: {docker_image: {"status", "digest", "error", "date"}}}
+        self.images = {docker_host["domain"]: {} for docker_host in DOCKER_HOSTS}
+
+    def start(self, app: Flask) -> None:
+        """
+        Start the warmer thread (first pull at startup, then every `interval`).
+        """
+        self.app = app
+        Thread(target=self.run, name="image-warmer", daemon=True).start()
+
+    def set_status(self, host_domain: str, image: str, status: str, **kwargs) -> None:
+        with self.lock:
+            self.images[host_domain][image] = {
+                "status": status,
+                "digest": kwargs.get("digest"),
+                "error": kwargs.get("error"),
+                "date": datetime.utcnow(),
+            }
+
+    def has_images(self, host_domain: str, images: set[str]) -> bool:
+        """
+        Returns True if all the images are known to be present on the host.
+        """
+        with self.lock:
+            cache = self.images.get(host_domain, {})
+            return all(
+                cache.get(image, {}).get("status") == "present" for image in images
+            )
+
+    def ensure_image(self, docker_host: dict, image: str) -> None:
+        """
+        Pull an image if it is missing on the host, raises on pull errors.
+        """
+        client = docker_host["client"]
+        try:
+            with HOSTS.call(docker_host["domain"], "images.inspect"):
+                digest = client.images.get(image).id
+        except ImageNotFound:
+            self.set_status(docker_host["domain"], image, "pulling")
+            try:
+                with HOSTS.call(docker_host["domain"], "images.pull"):
+                    digest = client.images.pull(image).id
+            except Exception as err:
+                self.set_status(docker_host["domain"], image, "error", error=str(err))
+                raise
+        self.set_status(docker_host["domain"], image, "present", digest=digest)
+
+    def ensure_images(self, docker_host: dict, images: set[str]) -> None:
+        """
+        Make sure the images of a deployment are present on the host.
+        """
+        if self.has_images(docker_host["domain"], images):
+            return
+
+        for image in images:
+            self.ensure_image(docker_host, image)
+
+    def warm(self, docker_host: dict, image: str) -> None:
+        try:
+            self.ensure_image(docker_host, image)
+        except Exception as err:
+            self.app.logger.error(
+                "Unable to pull '%s' on host '%s': %s",
+                image,
+                docker_host["domain"],
+                err,
+            )
+
+    def warm_all(self) -> None:
+        """
+        Pull every challenge image on every host (except the down ones) in parallel.
+        """
+        tasks = [
+            (docker_host, image)
+            for docker_host in DOCKER_HOSTS
+            for image in CHALLENGES_IMAGES
+            if not HOSTS.is_down(docker_host["domain"])
+        ]
+        if not tasks:
+            return
+
+        with ThreadPoolExecutor(
+            max_workers=min(len(tasks), 16), thread_name_prefix="image-warmer"
+        ) as executor:
+            list(executor.map(lambda task: self.warm(*task), tasks))
+
+    def run(self) -> None:
+        while True:
+            self.warm_all()
+            self.wakeup.wait(timeout=self.interval)
+            self.wakeup.clear()
+
+    def status(self) -> dict:
+        """
+        Returns the pull status of every image on every host.
+        """
+        with self.lock:
+            return {
+                host_domain: {
+                    image: dict(
+                        self.images[host_domain].get(image, {"status": "unknown"})
+                    )
+                    for image in CHALLENGES_IMAGES
+                }
+                for host_domain in self.images
+            }
+
+
+IMAGE_WARMER = ImageWarmer()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+import secrets
+import time
+from datetime import datetime, timedelta
+from queue import Full, Queue
+from threading import Lock, Thread
+from typing import Optional
+
+from flask import Flask
+
+from app.config import DEPLOY_QUEUE_SIZE, DEPLOY_WORKERS, ChallengeTemplate
+from app.counters import COUNTERS, Reservation
+from app.database import db
+from app.metrics import DEPLOY_STAGE_SECONDS
+from app.models import Deployments
+from app.utils import create_instances, remove_user_running_instance, reset_deployment
+
+
+class DeployJob:
+    """
+    Deployment of a challenge requested by a user, or reset of the deployment
+    `network_name` in place.
+
+    status: queued -> pulling -> starting -> ready (or failed)
+    """
+
+    def __init__(
+        self,
+        user: dict,
+        challenge: ChallengeTemplate,
+        reservation: Optional[Reservation] = None,
+        network_name: Optional[str] = None,
+    ):
+        self.id = secrets.token_hex(16)
+        self.user = user
+        self.challenge = challenge
+        self.reservation = reservation
+        self.network_name = network_name
+        self.action = "reset" if network_name else "deploy"
+        self.status = "queued"
+        self.message = (
+            f"Reset of {challenge.name} is queued..."
+            if network_name
+            else f"Deployment of {challenge.name} is queued..."
+        )
+        self.creation_date = datetime.utcnow()
+        self.update_date = self.creation_date
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ["ready", "failed"]
+
+    def set_status(self, status: str, message: Optional[str] = None) -> None:
+        self.status = status
+        if message is not None:
+            self.message = message
+        self.update_date = datetime.utcnow()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "action": self.action,
+            "challenge_name": self.challenge.name,
+            "status": self.status,
+            "message": self.message,
+            "creation_date": self.creation_date,
+            "update_date": self.update_date,
+        }
+
+
+class DeployQueue:
+    """
+    Queue of deployments consumed by a pool of workers, separated from the web threads.
+    """
+
+    def __init__(self, workers: int = DEPLOY_WORKERS, size: int = DEPLOY_QUEUE_SIZE):
+        self.app = None
+        self.workers = workers
+        self.queue = Queue(maxsize=size)
+        self.jobs = {}
+        self.lock = Lock()
+        # Moving average of the duration of a deployment (seconds)
+        self.average_duration = 10.0
+
+    def start(self, app: Flask) -> None:
+        """
+        Start the deploy workers.
+        """
+        self.app = app
+        for i in range(self.workers):
+            Thread(target=self.run, name=f"deploy-worker-{i}", daemon=True).start()
+
+    def get(self, job_id: str) -> Optional[DeployJob]:
+        return self.jobs.get(job_id)
+
+    def get_user_job(self, user_id: int) -> Optional[DeployJob]:
+        """
+        Returns the pending deployment of a user, if any.
+        """
+        with self.lock:
+            for job in self.jobs.values():
+                if job.user["user_id"] == user_id and not job.finished:
+                    return job
+        return None
+
+    def retry_after(self) -> float:
+        """
+        Estimated seconds for the workers to drain the queue.
+        """
+        with self.lock:
+            average_duration = self.average_duration
+        return self.queue.qsize() * average_duration / self.workers
+
+    def submit(
+        self,
+        user: dict,
+        challenge: ChallengeTemplate,
+        reservation: Optional[Reservation] = None,
+        network_name: Optional[str] = None,
+    ) -> Optional[DeployJob]:
+        """
+        Enqueue a deployment holding the capacity of `reservation` (or the reset of
+        the deployment `network_name`), returns None if the queue is full.
+        """
+        job = DeployJob(user, challenge, reservation, network_name)
+        try:
+            self.queue.put_nowait(job)
+        except Full:
+            return None
+
+        with self.lock:
+            expired = datetime.utcnow() - timedelta(hours=1)
+            for job_id, old_job in list(self.jobs.items()):
+                if old_job.finished and old_job.update_date < expired:
+                    del self.jobs[job_id]
+            self.jobs[job.id] = job
+        return job
+
+    def run(self) -> None:
+        while True:
+            job = self.queue.get()
+            start = time.perf_counter()
+            with self.app.app_context():
+                try:
+                    if job.network_name:
+                        self.reset(job)
+                    else:
+                        self.deploy(job)
+                except Exception as err:
+                    self.app.logger.error("Error while creating instances: %s", err)
+                    db.session.rollback()
+                    job.set_status(
+                        "failed",
+                        "An error occurred while creating your instance. Please contact an administrator.",
+                    )
+                COUNTERS.release(job.reservation)
+            with self.lock:
+                self.average_duration += 0.2 * (
+                    time.perf_counter() - start - self.average_duration
+                )
+            self.queue.task_done()
+
+    def deploy(self, job: DeployJob) -> None:
+        """
+        Replace the running instance of the user by a new deployment.
+        """
+        with DEPLOY_STAGE_SECONDS.time(stage="reap"):
+            remove_user_running_instance(job.user["user_id"])
+
+        with DEPLOY_STAGE_SECONDS.time(stage="total"):
+            nb_container = create_instances(
+                job.user,
+                job.challenge,
+                on_status=job.set_status,
+                reservation=job.reservation,
+            )
+        challenge_name = job.challenge.name
+
+        if nb_container == 1:
+            job.set_status(
+                "ready", f"{nb_container} container is running for {challenge_name}."
+            )
+        elif nb_container > 1:
+            job.set_status(
+                "ready", f"{nb_container} containers are running for {challenge_name}."
+            )
+        else:
+            job.set_status(
+                "failed",
+                "An error occurred while creating your instance. Please contact an administrator.",
+            )
+
+    def reset(self, job: DeployJob) -> None:
+        """
+        Recreate the containers of the deployment of the user in place.
+        """
+        deployment = Deployments.query.filter_by(
+            network_name=job.network_name, user_id=job.user["user_id"]
+        ).first()
+        if not deployment:
+            job.set_status("failed", "Unable to find an instance to reset.")
+            return
+
+        job.set_status(
+            "starting", f"Recreating the containers of {job.challenge.name}..."
+        )
+        success, message = reset_deployment(deployment)
+        job.set_status("ready" if success else "failed", message)
+
+
+DEPLOY_QUEUE = DeployQueue()
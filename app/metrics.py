@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from typing import Callable, Iterator
+
+from docker.errors import NotFound
+
+# Seconds, from a cached lookup to a slow image pull
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(labelnames: tuple[str, ...], values: tuple, **extra) -> str:
+    labels = list(zip(labelnames, values)) + list(extra.items())
+    if not labels:
+        return ""
+    escaped = (
+        (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metric:
+    """
+    Base of the metrics rendered in the Prometheus text format.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.lock = Lock()
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values = {}
+
+    def inc(self, value: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            values = dict(self.values)
+        for key, value in values.items():
+            yield f"{self.name}{format_labels(self.labelnames, key)} {value}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        # {labels: [count per bucket..., count of +Inf, sum]}
+        self.values = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the duration of the block, even if it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            values = {key: list(counts) for key, counts in self.values.items()}
+
+        for key, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = format_labels(self.labelnames, key, le=bound)
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {counts[-1]}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Gauge(Metric):
+    """
+    Gauge read from a callback at scrape time, returning {labels: value}.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, *args, callback: Callable[[], dict[tuple, float]], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.callback = callback
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self.callback().items():
+            yield f"{self.name}{format_labels(self.labelnames, key)} {value}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+DEPLOY_STAGE_SECONDS = REGISTRY.register(
+    Histogram(
+        "deploy_stage_seconds",
+        "Duration of each stage of a deployment.",
+        ("stage",),
+    )
+)
+DOCKER_API_SECONDS = REGISTRY.register(
+    Histogram(
+        "docker_api_seconds",
+        "Latency of the Docker API calls per challenge host.",
+        ("host", "operation"),
+    )
+)
+DOCKER_API_ERRORS = REGISTRY.register(
+    Counter(
+        "docker_api_errors_total",
+        "Failed Docker API calls per challenge host.",
+        ("host", "operation"),
+    )
+)
+CTFD_API_SECONDS = REGISTRY.register(
+    Histogram("ctfd_api_seconds", "Latency of the CTFd API calls.", ("endpoint",))
+)
+CTFD_API_ERRORS = REGISTRY.register(
+    Counter("ctfd_api_errors_total", "Failed CTFd API calls.", ("endpoint",))
+)
+ACCESS_KEY_SECONDS = REGISTRY.register(
+    Histogram(
+        "access_key_check_seconds",
+        "Duration of the access key checks (CTFd calls or cache).",
+    )
+)
+
+
+@contextmanager
+def docker_call(host_domain: str, operation: str):
+    """
+    Time a Docker API call and count its errors (except missing objects).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except NotFound:
+        raise
+    except Exception:
+        DOCKER_API_ERRORS.inc(host=host_domain, operation=operation)
+        raise
+    finally:
+        DOCKER_API_SECONDS.observe(
+            time.perf_counter() - start, host=host_domain, operation=operation
+        )
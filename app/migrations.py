@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+from datetime import timedelta
+
+from flask import current_app
+from sqlalchemy import MetaData, Table, inspect, select, text
+from sqlalchemy.schema import DropTable
+
+from app.config import MAX_INSTANCE_DURATION
+from app.database import db
+from app.models import Deployments, Instances
+
+
+def migrate_legacy_instances() -> None:
+    """
+    Move the rows of the legacy `instances` table (one row per container repeating
+    the team, user, network and host) to the deployments/deployment_instances tables.
+    """
+    if "instances" not in inspect(db.engine).get_table_names():
+        return
+
+    # Reflect the legacy table so that the dates are parsed on every backend
+    legacy = Table("instances", MetaData(), autoload_with=db.engine)
+    rows = db.session.execute(select(legacy).order_by(legacy.c.id)).mappings()
+
+    deployments = {}
+    for row in rows:
+        deployment = deployments.get(row["network_name"])
+        if deployment is None:
+            deployment = Deployments(
+                user_id=row["user_id"],
+                user_name=row["user_name"],
+                team_id=row["team_id"],
+                team_name=row["team_name"],
+                challenge_name=row["challenge_name"],
+                network_name=row["network_name"],
+                host_domain=row["host_domain"],
+                creation_date=row["creation_date"],
+                deadline=row["creation_date"]
+                + timedelta(minutes=MAX_INSTANCE_DURATION),
+            )
+            deployments[row["network_name"]] = deployment
+            db.session.add(deployment)
+
+        deployment.instances.append(
+            Instances(
+                hostname=row["hostname"],
+                ip_address=row["ip_address"],
+                instance_name=row["instance_name"],
+                docker_image=row["docker_image"],
+                ports=row["ports"],
+            )
+        )
+
+    db.session.execute(DropTable(legacy))
+    db.session.commit()
+    current_app.logger.info(
+        "Migrated %d deployments from the legacy instances table.", len(deployments)
+    )
+
+
+def add_deployments_state() -> None:
+    """
+    Add the state column (running, exited, oom_killed) to the deployments table.
+    """
+    columns = inspect(db.engine).get_columns(Deployments.__tablename__)
+    if "state" in [column["name"] for column in columns]:
+        return
+
+    db.session.execute(
+        text(
+            f"ALTER TABLE {Deployments.__tablename__} "
+            "ADD COLUMN state VARCHAR(16) NOT NULL DEFAULT 'running'"
+        )
+    )
+    db.session.commit()
+    current_app.logger.info("Added the state column to the deployments table.")
+
+
+def add_deployments_extensions() -> None:
+    """
+    Add the extensions column (number of deadline extensions) to the deployments
+    table.
+    """
+    columns = inspect(db.engine).get_columns(Deployments.__tablename__)
+    if "extensions" in [column["name"] for column in columns]:
+        return
+
+    db.session.execute(
+        text(
+            f"ALTER TABLE {Deployments.__tablename__} "
+            "ADD COLUMN extensions INTEGER NOT NULL DEFAULT 0"
+        )
+    )
+    db.session.commit()
+    current_app.logger.info("Added the extensions column to the deployments table.")
+
+
+def add_deployments_reset_date() -> None:
+    """
+    Add the reset_date column (start or end of the last reset) to the deployments
+    table.
+    """
+    columns = inspect(db.engine).get_columns(Deployments.__tablename__)
+    if "reset_date" in [column["name"] for column in columns]:
+        return
+
+    db.session.execute(
+        text(f"ALTER TABLE {Deployments.__tablename__} ADD COLUMN reset_date TIMESTAMP")
+    )
+    db.session.commit()
+    current_app.logger.info("Added the reset_date column to the deployments table.")
+
+
+# Each migration must be idempotent, they all run at startup
+MIGRATIONS = [
+    migrate_legacy_instances,
+    add_deployments_state,
+    add_deployments_extensions,
+    add_deployments_reset_date,
+]
+
+
+def upgrade() -> None:
+    """
+    Apply the schema migrations on the current database.
+    """
+    for migration in MIGRATIONS:
+        migration()
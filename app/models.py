@@ -3,20 +3,36 @@ from datetime import datetime
 from app.database import db
 
 
-class Instances(db.Model):
+class Deployments(db.Model):
     """
     id (int) : Primary key.
     user_id (int) : CTFd User ID.
     user_name (str) : CTFd Username.
     team_id (int) : CTFd Team ID.
     team_name (str) : CTFd Team name.
-    docker_image (str) : Docker image deployed by the user.
-    ports (str) : Port mapped for the docker instance.
-    instance_name (str) : Random name for the instance.
-    docker_client_id (int) : Challenges hosts ID.
-    creation_date (date) : Date of instance creation.
+    challenge_name (str) : Name of the challenge deployed.
+    network_name (str) : Random name of the deployment network.
+    host_domain (str) : Challenge host running the deployment.
+    creation_date (date) : Date of deployment creation.
+    deadline (date) : Date of deployment expiration.
+    state (str) : running, exited or oom_killed (from the docker events), resetting
+        while its containers are recreated.
+    extensions (int) : Number of times the deadline was extended.
+    reset_date (date) : Start of the current reset, or end of the last one.
+    instances (list) : Containers of the deployment.
     """
 
+    __table_args__ = (
+        db.Index("ix_deployments_team_id_challenge_name", "team_id", "challenge_name"),
+        db.Index("ix_deployments_user_id", "user_id"),
+        db.Index("ix_deployments_deadline", "deadline"),
+        db.Index(
+            "ix_deployments_host_domain_challenge_name",
+            "host_domain",
+            "challenge_name",
+        ),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
 
     user_id = db.Column(db.Integer, unique=False, nullable=False)
@@ -25,15 +41,140 @@ class Instances(db.Model):
     team_name = db.Column(db.String(128), unique=False, nullable=False)
 
     challenge_name = db.Column(db.String(128), unique=False, nullable=False)
-    network_name = db.Column(db.String(128), unique=False, nullable=False)
+    network_name = db.Column(db.String(128), unique=True, nullable=False)
+    host_domain = db.Column(db.String(128), unique=False, nullable=False)
+
+    creation_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    deadline = db.Column(db.DateTime, nullable=False)
+    state = db.Column(
+        db.String(16), nullable=False, default="running", server_default="running"
+    )
+    extensions = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    reset_date = db.Column(db.DateTime, nullable=True)
+
+    instances = db.relationship(
+        "Instances",
+        backref="deployment",
+        lazy="selectin",
+        order_by="Instances.id",
+        cascade="all, delete-orphan",
+    )
+
+    def __repr__(self):
+        return f"[{self.id}] {self.challenge_name} on {self.host_domain} until {self.deadline}"
+
+
+class Instances(db.Model):
+    """
+    id (int) : Primary key.
+    deployment_id (int) : Deployment of the container.
+    docker_image (str) : Docker image deployed by the user.
+    hostname (str) : Hostname of the container in the deployment network.
+    ip_address (str) : IP address of the container in the deployment network.
+    ports (str) : Port mapped for the docker instance.
+    instance_name (str) : Random name for the instance.
+    """
+
+    __tablename__ = "deployment_instances"
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    deployment_id = db.Column(
+        db.Integer, db.ForeignKey("deployments.id"), index=True, nullable=False
+    )
+
     hostname = db.Column(db.String(128), unique=False, nullable=False)
     ip_address = db.Column(db.String(32), unique=False, nullable=False)
     instance_name = db.Column(db.String(128), unique=True, nullable=False)
     docker_image = db.Column(db.String(128), unique=False, nullable=False)
-    host_domain = db.Column(db.String(128), unique=False, nullable=False)
     ports = db.Column(db.String(256), unique=False, nullable=True)
 
+    def __repr__(self):
+        return f"[{self.id}] {self.docker_image} ({self.instance_name})"
+
+
+class Reservations(db.Model):
+    """
+    Capacity held by a deployment not yet saved in DB, shared by the replicas.
+
+    id (int) : Primary key.
+    team_id (int) : CTFd Team ID.
+    instances (int) : Number of containers of the deployment.
+    replica (str) : Replica holding the reservation.
+    expires_at (date) : Date after which a leftover reservation is ignored.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    team_id = db.Column(db.Integer, index=True, nullable=False)
+    instances = db.Column(db.Integer, nullable=False)
+    replica = db.Column(db.String(128), unique=False, nullable=False)
+
+    expires_at = db.Column(db.DateTime, index=True, nullable=False)
+
+    def __repr__(self):
+        return f"[{self.id}] {self.instances} containers for team {self.team_id}"
+
+
+class Leases(db.Model):
+    """
+    name (str) : Primary key, name of the role (ex: leader).
+    holder (str) : Replica holding the role.
+    expires_at (date) : Date after which another replica can take the role.
+    """
+
+    name = db.Column(db.String(64), primary_key=True)
+    holder = db.Column(db.String(128), unique=False, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"{self.name} held by {self.holder} until {self.expires_at}"
+
+
+class PortLeases(db.Model):
+    """
+    id (int) : Primary key.
+    host_domain (str) : Challenge host on which the port is mapped.
+    port (int) : Port leased on the challenge host.
+    instance_name (str) : Random name of the instance holding the port ("pending"
+        until the deployment is saved, in multi-replica mode).
+    creation_date (date) : Date of lease creation.
+    """
+
+    __table_args__ = (db.UniqueConstraint("host_domain", "port"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    host_domain = db.Column(db.String(128), unique=False, nullable=False)
+    port = db.Column(db.Integer, unique=False, nullable=False)
+    instance_name = db.Column(db.String(128), unique=False, nullable=False)
+
     creation_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
     def __repr__(self):
-        return f"[{self.id}] {self.docker_image} at {self.creation_date}"
+        return f"[{self.id}] {self.host_domain}:{self.port} for {self.instance_name}"
+
+
+class Events(db.Model):
+    """
+    Lifecycle event of a deployment, shared by the replicas.
+
+    id (int) : Primary key.
+    type (str) : starting, ready, failed, expiring, removed, ...
+    team_id (int) : CTFd Team ID of the deployment.
+    data (str) : JSON payload of the event.
+    creation_date (date) : Date of the event.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    type = db.Column(db.String(32), unique=False, nullable=False)
+    team_id = db.Column(db.Integer, unique=False, nullable=False)
+    data = db.Column(db.Text, unique=False, nullable=False)
+
+    creation_date = db.Column(
+        db.DateTime, index=True, nullable=False, default=datetime.utcnow
+    )
+
+    def __repr__(self):
+        return f"[{self.id}] {self.type} for team {self.team_id}"
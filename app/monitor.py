@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+import time
+from threading import Thread
+
+from flask import Flask
+
+from app.cluster import LEADER
+from app.config import DOCKER_EVENTS_MAX_BACKOFF, DOCKER_EVENTS_WINDOW, DOCKER_HOSTS
+from app.database import db
+from app.events import EVENTS
+from app.hosts import HOSTS
+from app.metrics import REGISTRY, Counter
+from app.models import Deployments
+from app.teardown import is_tearing_down, start_teardown
+from app.utils import LABEL_PREFIX, MANAGED_LABEL, is_resetting
+
+DOCKER_EVENTS_TOTAL = REGISTRY.register(
+    Counter(
+        "docker_events_total",
+        "Docker events of the challenge containers per host.",
+        ("host", "action"),
+    )
+)
+
+EVENTS_FILTERS = {
+    "type": ["container"],
+    "event": ["die", "oom", "destroy"],
+    "label": [f"{MANAGED_LABEL}=true"],
+}
+
+# State of a deployment after each event
+EVENT_STATES = {"die": "exited", "oom": "oom_killed"}
+
+
+class ContainerMonitor:
+    """
+    One thread per challenge host streaming the docker events of the containers of
+    the app, so that the DB follows a container that exits, is OOM-killed or is
+    removed outside of the app:
+
+    - die/oom: the state of the deployment is updated and the team is notified;
+    - destroy: the deployment is torn down, its ports and quota are freed.
+
+    The events are read by windows of `window` seconds, a stream is resumed from
+    the time of the last event received, with an exponential backoff on errors.
+    """
+
+    def __init__(
+        self,
+        window: int = DOCKER_EVENTS_WINDOW,
+        max_backoff: int = DOCKER_EVENTS_MAX_BACKOFF,
+    ):
+        self.app = None
+        self.window = window
+        self.max_backoff = max_backoff
+
+    def start(self, app: Flask) -> None:
+        """
+        Start a watcher thread per challenge host.
+        """
+        self.app = app
+        for docker_host in DOCKER_HOSTS:
+            Thread(
+                target=self.watch,
+                args=(docker_host,),
+                name=f"monitor-{docker_host['domain']}",
+                daemon=True,
+            ).start()
+
+    def handle(self, host_domain: str, event: dict) -> None:
+        action = event.get("Action") or event.get("status")
+        attributes = event.get("Actor", {}).get("Attributes", {})
+        network_name = attributes.get(f"{LABEL_PREFIX}.deployment")
+        DOCKER_EVENTS_TOTAL.inc(host=host_domain, action=action)
+
+        # The teardowns and the resets of the app also kill and destroy the containers
+        if not network_name or is_tearing_down(network_name):
+            return
+
+        with self.app.app_context():
+            deployment = Deployments.query.filter_by(network_name=network_name).first()
+            if deployment is None or is_resetting(
+                deployment.state, deployment.reset_date, event.get("time")
+            ):
+                return
+
+            if action == "destroy":
+                self.app.logger.warning(
+                    "Container '%s' of deployment '%s' was removed, removing the deployment.",
+                    attributes.get("name"),
+                    network_name,
+                )
+                # A teardown of another replica is not counted twice, the rows
+                # are deleted under a lock shared by the replicas
+                start_teardown(self.app, [network_name])
+                return
+
+            state = EVENT_STATES.get(action)
+            # An OOM kill is followed by a die event
+            if state is None or deployment.state in [state, "oom_killed"]:
+                return
+
+            self.app.logger.warning(
+                "Container '%s' of deployment '%s' stopped (%s, exit code %s).",
+                attributes.get("name"),
+                network_name,
+                state,
+                attributes.get("exitCode", "N/A"),
+            )
+            deployment.state = state
+            db.session.commit()
+            EVENTS.publish(
+                "exited",
+                deployment.team_id,
+                network_name=network_name,
+                challenge_name=deployment.challenge_name,
+                state=state,
+            )
+
+    def watch(self, docker_host: dict) -> None:
+        """
+        Stream the events of a host forever.
+        """
+        host_domain = docker_host["domain"]
+        since = int(time.time())
+        backoff = 1
+
+        while True:
+            # Only the leader replica follows the events
+            if not LEADER.is_leader:
+                time.sleep(self.window / 4)
+                since = int(time.time())
+                continue
+
+            if not HOSTS.is_available(host_domain):
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            until = int(time.time()) + self.window
+            try:
+                events = docker_host["client"].events(
+                    since=since, until=until, filters=EVENTS_FILTERS, decode=True
+                )
+                for event in events:
+                    self.handle(host_domain, event)
+                    since = max(since, event.get("time", since))
+                    backoff = 1
+
+                if time.time() < until - 1:
+                    raise ConnectionError("the events stream was closed")
+                since = until
+                backoff = 1
+            except Exception as err:
+                self.app.logger.warning(
+                    "Docker events of host '%s' interrupted, retrying in %ds: %s",
+                    host_domain,
+                    backoff,
+                    err,
+                )
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+
+MONITOR = ContainerMonitor()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+from datetime import datetime, timedelta
+from threading import Event, Thread
+from typing import Optional
+
+from flask import Flask, current_app
+
+from app.cluster import LEADER
+from app.config import (
+    CHALLENGES,
+    MAX_INSTANCE_COUNT,
+    MAX_INSTANCE_DURATION,
+    WARM_POOL_INTERVAL,
+)
+from app.counters import COUNTERS, Reservation
+from app.database import db
+from app.events import EVENTS
+from app.models import Deployments
+from app.teardown import remove_deployments, start_teardown
+from app.utils import create_instances, get_challenge_info
+
+# Owner of the deployments waiting in the warm pool
+POOL_USER = {
+    "user_id": 0,
+    "user_name": "warm-pool",
+    "team_id": 0,
+    "team_name": "warm-pool",
+}
+
+
+def get_pooled_deployments(challenge_name: str) -> list[str]:
+    """
+    Returns the unassigned deployments of a challenge, oldest first.
+    """
+    return [
+        network_name
+        for (network_name,) in db.session.query(Deployments.network_name)
+        .filter_by(team_id=POOL_USER["team_id"], challenge_name=challenge_name)
+        .order_by(Deployments.creation_date)
+    ]
+
+
+def claim_pooled_deployment(
+    user: dict, challenge_name: str, reservation: Optional[Reservation] = None
+) -> bool:
+    """
+    Assign a deployment of the warm pool to a user, their previous deployments are
+    removed in background. Returns False if the pool of the challenge is empty.
+    """
+    previous = [
+        network_name
+        for (network_name,) in db.session.query(Deployments.network_name).filter_by(
+            user_id=user["user_id"]
+        )
+    ]
+
+    for network_name in get_pooled_deployments(challenge_name):
+        # Only one user can update the row still owned by the pool
+        now = datetime.utcnow()
+        with COUNTERS.changing():
+            claimed = Deployments.query.filter_by(
+                network_name=network_name, team_id=POOL_USER["team_id"]
+            ).update(
+                {
+                    "user_id": user["user_id"],
+                    "user_name": user["user_name"],
+                    "team_id": user["team_id"],
+                    "team_name": user["team_name"],
+                    "creation_date": now,
+                    "deadline": now + timedelta(minutes=MAX_INSTANCE_DURATION),
+                },
+                synchronize_session=False,
+            )
+            db.session.commit()
+            if claimed:
+                COUNTERS.move(
+                    POOL_USER["team_id"],
+                    user["team_id"],
+                    len(get_challenge_info(challenge_name).containers),
+                    reservation,
+                )
+
+        if claimed:
+            EVENTS.publish(
+                "ready",
+                user["team_id"],
+                user_id=user["user_id"],
+                challenge_name=challenge_name,
+                network_name=network_name,
+            )
+            current_app.logger.debug(
+                "User n°%d claimed pooled deployment '%s'.",
+                user["user_id"],
+                network_name,
+            )
+            if previous:
+                start_teardown(current_app._get_current_object(), previous)
+            WARM_POOL.wakeup.set()
+            return True
+
+    return False
+
+
+class WarmPool:
+    """
+    Background filler keeping `warm_pool` started deployments per challenge.
+    """
+
+    def __init__(self, interval: int = WARM_POOL_INTERVAL):
+        self.app = None
+        self.interval = interval
+        self.wakeup = Event()
+        self.targets = {}
+
+    def start(self, app: Flask) -> None:
+        """
+        Start the filler thread, only if a challenge has a warm pool.
+        """
+        self.app = app
+        if any(challenge.warm_pool for challenge in CHALLENGES):
+            Thread(target=self.run, name="warm-pool", daemon=True).start()
+
+    def get_targets(self) -> dict[str, int]:
+        """
+        Returns the pool size of each challenge, shrunk when the free capacity
+        (MAX_INSTANCE_COUNT) runs low: the pools never use more than half of it.
+        """
+        pooled = COUNTERS.team_instance_count(POOL_USER["team_id"])
+        available = MAX_INSTANCE_COUNT - (COUNTERS.total - pooled)
+
+        sizes = {challenge.name: challenge.warm_pool for challenge in CHALLENGES}
+        containers = {
+            challenge.name: len(challenge.containers) for challenge in CHALLENGES
+        }
+        wanted = sum(sizes[name] * containers[name] for name in sizes)
+        budget = max(available // 2, 0)
+
+        if wanted > budget:
+            sizes = {name: size * budget // wanted for name, size in sizes.items()}
+        return sizes
+
+    def fill(self) -> None:
+        """
+        Create or remove pooled deployments to reach the target sizes.
+        """
+        self.targets = self.get_targets()
+
+        for challenge in CHALLENGES:
+            target = self.targets[challenge.name]
+            pooled = get_pooled_deployments(challenge.name)
+
+            if len(pooled) > target:
+                remove_deployments(self.app, pooled[target:])
+                continue
+
+            for _ in range(target - len(pooled)):
+                if not create_instances(POOL_USER, challenge, strategy="spread"):
+                    self.app.logger.error(
+                        "Unable to fill the warm pool of '%s'.", challenge.name
+                    )
+                    break
+
+    def run(self) -> None:
+        while True:
+            # Only the leader replica fills the pools
+            if not LEADER.is_leader:
+                self.wakeup.wait(timeout=self.interval)
+                self.wakeup.clear()
+                continue
+
+            with self.app.app_context():
+                try:
+                    self.fill()
+                except Exception as err:
+                    self.app.logger.error("Unable to fill the warm pool: %s", err)
+                    db.session.rollback()
+
+            self.wakeup.wait(timeout=self.interval)
+            self.wakeup.clear()
+
+
+WARM_POOL = WarmPool()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+import random
+from threading import Lock
+from typing import Optional
+
+from flask import current_app
+
+from app.cluster import db_lock
+from app.config import DOCKER_HOSTS, MAX_PORTS, MIN_PORTS, MULTI_REPLICA
+from app.database import db
+from app.hosts import HOSTS
+from app.models import PortLeases
+
+# Instance name of the ports leased before the deployment is saved (MULTI_REPLICA)
+PENDING_LEASE = "pending"
+
+
+class PortAllocator:
+    """
+    Bitmap of the ports used on a challenge host (between MIN_PORTS and MAX_PORTS).
+    """
+
+    def __init__(
+        self, domain: str, min_port: int = MIN_PORTS, max_port: int = MAX_PORTS
+    ):
+        self.domain = domain
+        self.min_port = min_port
+        self.size = max_port - min_port + 1
+        self.bitmap = bytearray((self.size + 7) // 8)
+        self.free = self.size
+        self.lock = Lock()
+        # Ports of the containers found on the host without a lease
+        self.external = set()
+
+    def _is_used(self, offset: int) -> bool:
+        return bool(self.bitmap[offset >> 3] & (1 << (offset & 7)))
+
+    def _set_used(self, offset: int, used: bool) -> None:
+        if self._is_used(offset) == used:
+            return
+
+        if used:
+            self.bitmap[offset >> 3] |= 1 << (offset & 7)
+            self.free -= 1
+        else:
+            self.bitmap[offset >> 3] &= ~(1 << (offset & 7))
+            self.free += 1
+
+    def mark_used(self, ports: list[int]) -> None:
+        """
+        Flag ports as used, ports outside of the range are ignored.
+        """
+        with self.lock:
+            for port in ports:
+                if 0 <= port - self.min_port < self.size:
+                    self._set_used(port - self.min_port, True)
+
+    def sync(self, ports: list[int]) -> None:
+        """
+        Flag the ports of the containers running on the host as used.
+        """
+        with self.lock:
+            self.external = set(ports)
+        self.mark_used(ports)
+
+    def refresh(self, leased: list[int]) -> None:
+        """
+        Rebuild the bitmap from the leases of every replica and the ports found on
+        the host, the ports freed by the other replicas become available.
+        """
+        with self.lock:
+            self.external.difference_update(leased)
+            self.bitmap = bytearray(len(self.bitmap))
+            self.free = self.size
+            for port in list(leased) + list(self.external):
+                if 0 <= port - self.min_port < self.size:
+                    self._set_used(port - self.min_port, True)
+
+    def allocate(self, count: int) -> Optional[list[int]]:
+        """
+        Reserve `count` random free ports at once, returns None if there is not enough free ports.
+        """
+        with self.lock:
+            if count > self.free:
+                return None
+
+            ports = []
+            for _ in range(count):
+                offset = random.randrange(self.size)
+                while self._is_used(offset):
+                    offset = (offset + 1) % self.size
+
+                self._set_used(offset, True)
+                ports.append(self.min_port + offset)
+
+            return ports
+
+    def release(self, ports: list[int]) -> None:
+        """
+        Flag ports as free.
+        """
+        with self.lock:
+            for port in ports:
+                if 0 <= port - self.min_port < self.size:
+                    self._set_used(port - self.min_port, False)
+
+
+PORT_ALLOCATORS = {
+    docker_host["domain"]: PortAllocator(docker_host["domain"])
+    for docker_host in DOCKER_HOSTS
+}
+
+
+def get_container_host_ports(container) -> list[int]:
+    """
+    Returns the host ports mapped by a docker container.
+    """
+    # Sparse container from a list call
+    if isinstance(container.attrs.get("Ports"), list):
+        return [
+            int(port["PublicPort"])
+            for port in container.attrs["Ports"]
+            if port.get("PublicPort")
+        ]
+
+    host_ports = []
+    for bindings in (container.ports or {}).values():
+        for binding in bindings or []:
+            if binding.get("HostPort", "").isdigit():
+                host_ports.append(int(binding["HostPort"]))
+    return host_ports
+
+
+def rebuild_port_allocators() -> None:
+    """
+    Rebuild the ports bitmaps from the leases in DB, the ports of the containers are
+    added by `sync_host_ports` once each host is reachable.
+    """
+    for lease in PortLeases.query.all():
+        if lease.host_domain in PORT_ALLOCATORS:
+            PORT_ALLOCATORS[lease.host_domain].mark_used([lease.port])
+
+
+def sync_host_ports(host_domain: str) -> None:
+    """
+    Flag the ports of the containers running on a host as used, raises on errors
+    so that the host is not used before its ports are known. The sparse listing
+    has the published ports, no container is inspected.
+    """
+    docker_host = next(
+        docker_host
+        for docker_host in DOCKER_HOSTS
+        if docker_host["domain"] == host_domain
+    )
+    with HOSTS.call(host_domain, "containers.list"):
+        containers = docker_host["client"].containers.list(sparse=True)
+
+    PORT_ALLOCATORS[host_domain].sync(
+        [
+            port
+            for container in containers
+            for port in get_container_host_ports(container)
+        ]
+    )
+
+
+def allocate_ports(host_domain: str, count: int) -> Optional[list[int]]:
+    """
+    Reserve all the ports needed by a deployment on a specific challenge host.
+    """
+    if MULTI_REPLICA:
+        ports = claim_ports(host_domain, count)
+    else:
+        ports = PORT_ALLOCATORS[host_domain].allocate(count)
+    if ports is None:
+        current_app.logger.error(
+            "Unable to find %d unused ports on host '%s'.", count, host_domain
+        )
+    return ports
+
+
+def claim_ports(host_domain: str, count: int) -> Optional[list[int]]:
+    """
+    Multi-replica variant of the allocation: under a lock shared by the replicas,
+    the bitmap is refreshed from the leases in DB and the ports are leased at once
+    (pending until the deployment is saved).
+    """
+    allocator = PORT_ALLOCATORS[host_domain]
+    ports = None
+    try:
+        with db_lock(f"ports:{host_domain}"):
+            allocator.refresh(
+                [
+                    port
+                    for (port,) in db.session.query(PortLeases.port).filter_by(
+                        host_domain=host_domain
+                    )
+                ]
+            )
+            ports = allocator.allocate(count)
+            for port in ports or []:
+                db.session.add(
+                    PortLeases(
+                        host_domain=host_domain, port=port, instance_name=PENDING_LEASE
+                    )
+                )
+    except Exception:
+        if ports:
+            allocator.release(ports)
+        raise
+    return ports
+
+
+def release_ports(host_domain: str, ports: list[int]) -> None:
+    """
+    Free ports that have not been leased (ex: failed deployment).
+    """
+    PORT_ALLOCATORS[host_domain].release(ports)
+
+    if MULTI_REPLICA and ports:
+        PortLeases.query.filter(
+            PortLeases.host_domain == host_domain,
+            PortLeases.port.in_(ports),
+            PortLeases.instance_name == PENDING_LEASE,
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+
+def lease_ports(host_domain: str, instance_name: str, ports: list[int]) -> None:
+    """
+    Persist the ports of an instance, the caller is in charge of the commit.
+    """
+    if MULTI_REPLICA:
+        # The ports were leased as pending by `claim_ports`
+        PortLeases.query.filter(
+            PortLeases.host_domain == host_domain,
+            PortLeases.port.in_(ports),
+            PortLeases.instance_name == PENDING_LEASE,
+        ).update({"instance_name": instance_name}, synchronize_session=False)
+        return
+
+    for port in ports:
+        db.session.add(
+            PortLeases(host_domain=host_domain, port=port, instance_name=instance_name)
+        )
+
+
+def release_instances_ports(instances: list[tuple[str, str]]) -> None:
+    """
+    Free the ports leased by many (host_domain, instance_name), in a single statement.
+    The caller is in charge of the commit.
+    """
+    instance_names = [instance_name for _, instance_name in instances]
+    leases = PortLeases.query.filter(PortLeases.instance_name.in_(instance_names))
+
+    for lease in leases.all():
+        if lease.host_domain in PORT_ALLOCATORS:
+            PORT_ALLOCATORS[lease.host_domain].release([lease.port])
+
+    leases.delete(synchronize_session=False)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+import heapq
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+
+from flask import Flask
+
+from app.cluster import LEADER
+from app.config import REAPER_INTERVAL
+from app.database import db
+from app.events import EVENTS
+from app.models import Deployments
+from app.teardown import remove_deployments
+
+
+class InstanceReaper:
+    """
+    Background thread removing the deployments once they reach MAX_INSTANCE_DURATION.
+
+    Deadlines are kept in a min-heap of (deadline, network_name), new deployments are
+    loaded incrementally from the Deployments table using their primary key. The
+    IDs are not committed in order (deploy workers, warm pool, replicas), so the
+    expired deployments missing from the heap are also swept on each pass.
+    """
+
+    def __init__(self, interval: int = REAPER_INTERVAL):
+        self.app = None
+        self.interval = interval
+        self.heap = []
+        self.deadlines = {}
+        self.last_id = 0
+        self.lock = Lock()
+        self.wakeup = Event()
+
+        self.removed = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.last_run = None
+
+    def start(self, app: Flask) -> None:
+        """
+        Start the reaper thread.
+        """
+        self.app = app
+        Thread(target=self.run, name="reaper", daemon=True).start()
+
+    def schedule(self, network_name: str, deadline: datetime) -> None:
+        """
+        Add (or move) the deadline of a deployment.
+        """
+        with self.lock:
+            if self.deadlines.get(network_name) == deadline:
+                return
+            self.deadlines[network_name] = deadline
+            heapq.heappush(self.heap, (deadline, network_name))
+        self.wakeup.set()
+
+    def load(self) -> None:
+        """
+        Load the deadlines of the deployments created since the last call.
+        """
+        rows = (
+            db.session.query(
+                Deployments.id, Deployments.network_name, Deployments.deadline
+            )
+            .filter(Deployments.id > self.last_id)
+            .all()
+        )
+
+        for deployment_id, network_name, deadline in rows:
+            self.schedule(network_name, deadline)
+            self.last_id = max(self.last_id, deployment_id)
+
+        # A deployment committed after one with a greater ID was skipped above
+        overdue = (
+            db.session.query(Deployments.network_name, Deployments.deadline)
+            .filter(Deployments.deadline <= datetime.utcnow())
+            .all()
+        )
+        for network_name, deadline in overdue:
+            with self.lock:
+                if network_name in self.deadlines:
+                    continue
+            self.schedule(network_name, deadline)
+
+    def pop_due(self, now: datetime) -> list[str]:
+        """
+        Returns the deployments whose deadline is over.
+        """
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, network_name = heapq.heappop(self.heap)
+                if self.deadlines.get(network_name) == deadline:
+                    del self.deadlines[network_name]
+                    due.append(network_name)
+        return due
+
+    def reap(self) -> None:
+        """
+        Remove every expired deployment.
+        """
+        now = datetime.utcnow()
+        due = self.pop_due(now)
+        if not due:
+            return
+
+        # The deadline may have changed since it was scheduled
+        rows = (
+            db.session.query(
+                Deployments.network_name, Deployments.deadline, Deployments.team_id
+            )
+            .filter(Deployments.network_name.in_(due))
+            .all()
+        )
+
+        expired = {}
+        for network_name, deadline, team_id in rows:
+            if deadline > now:
+                self.schedule(network_name, deadline)
+            else:
+                expired[network_name] = deadline
+                EVENTS.publish("expiring", team_id, network_name=network_name)
+
+        if not expired:
+            return
+
+        # The teardown engine batches the deployments per challenge host
+        self.app.logger.debug("Reaper is removing %d deployments...", len(expired))
+        job = remove_deployments(self.app, list(expired))
+
+        if job.status != "done":
+            retry = datetime.utcnow() + timedelta(seconds=self.interval)
+            for network_name in expired:
+                self.schedule(network_name, retry)
+            return
+
+        for deadline in expired.values():
+            self.last_lag = (datetime.utcnow() - deadline).total_seconds()
+            self.max_lag = max(self.max_lag, self.last_lag)
+            self.removed += 1
+
+    def run(self) -> None:
+        while True:
+            # Only the leader replica removes the expired deployments
+            if not LEADER.is_leader:
+                self.wakeup.wait(timeout=self.interval)
+                self.wakeup.clear()
+                continue
+
+            with self.app.app_context():
+                try:
+                    self.load()
+                    self.reap()
+                except Exception as err:
+                    self.app.logger.error("Unable to remove expired instances: %s", err)
+                    db.session.rollback()
+                self.last_run = datetime.utcnow()
+
+            self.wakeup.wait(timeout=self.next_wakeup())
+            self.wakeup.clear()
+
+    def next_wakeup(self) -> float:
+        """
+        Seconds to wait before the next deadline (at most `interval`).
+        """
+        with self.lock:
+            if not self.heap:
+                return self.interval
+            delay = (self.heap[0][0] - datetime.utcnow()).total_seconds()
+        return min(max(delay, 0), self.interval)
+
+    def stats(self) -> dict:
+        """
+        Returns the reaper lag and backlog.
+        """
+        now = datetime.utcnow()
+        with self.lock:
+            backlog = sum(1 for deadline in self.deadlines.values() if deadline <= now)
+            next_deadline = min(self.deadlines.values(), default=None)
+            scheduled = len(self.deadlines)
+
+        return {
+            "scheduled": scheduled,
+            "backlog": backlog,
+            "removed": self.removed,
+            "last_lag": round(self.last_lag, 3),
+            "max_lag": round(self.max_lag, 3),
+            "next_deadline": next_deadline,
+            "last_run": self.last_run,
+        }
+
+
+REAPER = InstanceReaper()
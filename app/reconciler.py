@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+from typing import Optional
+
+from flask import Flask
+
+from app.cluster import LEADER
+from app.config import DOCKER_HOSTS, RECONCILE_GRACE, RECONCILE_INTERVAL
+from app.database import db
+from app.hosts import HOSTS
+from app.metrics import REGISTRY, Counter
+from app.models import Deployments, Instances, PortLeases, Reservations
+from app.ports import PENDING_LEASE, get_container_host_ports, release_ports
+from app.teardown import (
+    get_container_name,
+    list_containers,
+    remove_container,
+    remove_deployments,
+    remove_network,
+)
+from app.utils import LABEL_PREFIX, MANAGED_LABEL, is_resetting
+
+RECONCILED_TOTAL = REGISTRY.register(
+    Counter(
+        "reconciler_removed_total",
+        "Stale deployments, orphaned docker objects and leftover claims removed by the reconciler.",
+        ("kind",),
+    )
+)
+
+
+def get_labels(docker_object) -> dict:
+    """
+    Labels of a container or a network, from the list or the inspect data.
+    """
+    attrs = docker_object.attrs
+    return attrs.get("Labels") or attrs.get("Config", {}).get("Labels") or {}
+
+
+def get_created(docker_object) -> datetime:
+    try:
+        created = int(get_labels(docker_object)[f"{LABEL_PREFIX}.created"])
+    except (KeyError, ValueError):
+        return datetime.min
+    return datetime.utcfromtimestamp(created)
+
+
+class DockerReconciler:
+    """
+    Background thread diffing the containers and networks labelled by the app on
+    each host against the deployments in DB:
+
+    - a deployment with a missing container (crashed, auto removed) is removed,
+      so that it stops counting against the quotas, the containers without labels
+      (created by an older version) are looked up by name first;
+    - a container or a network unknown in DB (failed deployment) is removed;
+    - the reservations and pending port leases left by a stopped replica are
+      deleted.
+
+    Each host is listed with one filtered call for the containers and one for the
+    networks (and one by name if containers are missing). Objects younger than `grace` seconds are ignored, their deployment
+    may not be saved yet.
+    """
+
+    def __init__(
+        self, interval: int = RECONCILE_INTERVAL, grace: int = RECONCILE_GRACE
+    ):
+        self.app = None
+        self.interval = interval
+        self.grace = grace
+        self.lock = Lock()
+        self.wakeup = Event()
+
+        self.last_run = None
+        self.last_result = {}
+
+    def start(self, app: Flask) -> None:
+        """
+        Start the reconciler thread.
+        """
+        self.app = app
+        Thread(target=self.run, name="reconciler", daemon=True).start()
+
+    def list_host(self, docker_host: dict) -> Optional[tuple[list, list]]:
+        """
+        Returns the containers and networks of the app on a host, None on error.
+        """
+        client = docker_host["client"]
+        filters = {"label": [f"{MANAGED_LABEL}=true"]}
+        try:
+            with HOSTS.call(docker_host["domain"], "containers.list"):
+                containers = client.containers.list(
+                    all=True, sparse=True, filters=filters
+                )
+            with HOSTS.call(docker_host["domain"], "networks.list"):
+                networks = client.networks.list(filters=filters)
+        except Exception as err:
+            self.app.logger.error(
+                "Unable to list the objects of host '%s': %s",
+                docker_host["domain"],
+                err,
+            )
+            return None
+        return containers, networks
+
+    def reconcile(self) -> dict:
+        """
+        Diff every available host against the DB and remove the differences.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=self.grace)
+
+        # {host_domain: {network_name: (creation_date, {instance_name, ...})}}
+        expected = defaultdict(dict)
+        resetting = set()
+        rows = (
+            db.session.query(
+                Deployments.host_domain,
+                Deployments.network_name,
+                Deployments.creation_date,
+                Deployments.state,
+                Deployments.reset_date,
+                Instances.instance_name,
+            )
+            .select_from(Deployments)
+            .outerjoin(Instances)
+            .all()
+        )
+        for (
+            host_domain,
+            network_name,
+            creation_date,
+            state,
+            reset_date,
+            instance_name,
+        ) in rows:
+            deployment = expected[host_domain].setdefault(
+                network_name, (creation_date, set())
+            )
+            if instance_name:
+                deployment[1].add(instance_name)
+            if is_resetting(state, reset_date):
+                resetting.add(network_name)
+        db.session.commit()
+
+        docker_hosts = [
+            docker_host
+            for docker_host in DOCKER_HOSTS
+            if HOSTS.is_available(docker_host["domain"])
+        ]
+        with ThreadPoolExecutor(
+            max_workers=max(len(docker_hosts), 1), thread_name_prefix="reconciler"
+        ) as executor:
+            listings = list(executor.map(self.list_host, docker_hosts))
+
+        stale = []
+        result = {"stale_deployments": 0, "orphan_containers": 0, "orphan_networks": 0}
+        for docker_host, listing in zip(docker_hosts, listings):
+            if listing is None:
+                continue
+
+            containers, networks = listing
+            deployments = expected.get(docker_host["domain"], {})
+            running = {get_container_name(container) for container in containers}
+
+            candidates = {
+                network_name: instance_names
+                for network_name, (creation_date, instance_names) in deployments.items()
+                if creation_date < cutoff
+                and not instance_names <= running
+                and network_name not in resetting
+            }
+            stale += self.find_stale(docker_host, candidates, running)
+
+            known_instances = set().union(
+                *(instance_names for _, instance_names in deployments.values())
+            )
+            orphan_containers = [
+                container
+                for container in containers
+                if get_container_name(container) not in known_instances
+                and get_created(container) < cutoff
+            ]
+            orphan_networks = [
+                network
+                for network in networks
+                if network.name not in deployments and get_created(network) < cutoff
+            ]
+            self.remove_orphans(docker_host, orphan_containers, orphan_networks)
+            result["orphan_containers"] += len(orphan_containers)
+            result["orphan_networks"] += len(orphan_networks)
+
+        # A reset may have started during the listing of the hosts
+        if stale:
+            stale = [
+                network_name
+                for network_name, state, reset_date in db.session.query(
+                    Deployments.network_name, Deployments.state, Deployments.reset_date
+                ).filter(Deployments.network_name.in_(stale))
+                if not is_resetting(state, reset_date)
+            ]
+            db.session.commit()
+
+        if stale:
+            self.app.logger.warning(
+                "Removing %d deployments with missing containers.", len(stale)
+            )
+            remove_deployments(self.app, stale)
+            result["stale_deployments"] = len(stale)
+
+        result.update(self.remove_stale_claims(cutoff))
+        for kind, count in result.items():
+            if count:
+                RECONCILED_TOTAL.inc(count, kind=kind)
+        return result
+
+    def find_stale(
+        self, docker_host: dict, candidates: dict[str, set], running: set
+    ) -> list[str]:
+        """
+        Returns the deployments with a missing container. The containers created
+        before the labels are not in the labelled listing, the missing ones are
+        looked up by name before their deployment is considered stale.
+        """
+        missing = set().union(*candidates.values()) - running
+        if not missing:
+            return []
+
+        try:
+            with HOSTS.call(docker_host["domain"], "containers.list"):
+                unlabelled = list_containers(docker_host["client"], sorted(missing))
+        except Exception as err:
+            self.app.logger.error(
+                "Unable to list the containers of host '%s': %s",
+                docker_host["domain"],
+                err,
+            )
+            return []
+
+        running = running | {get_container_name(container) for container in unlabelled}
+        return [
+            network_name
+            for network_name, instance_names in candidates.items()
+            if not instance_names <= running
+        ]
+
+    def remove_stale_claims(self, cutoff: datetime) -> dict:
+        """
+        Delete the expired reservations and the ports leased for a deployment that
+        was never saved.
+        """
+        reservations = Reservations.query.filter(
+            Reservations.expires_at < datetime.utcnow()
+        ).delete(synchronize_session=False)
+        port_leases = PortLeases.query.filter(
+            PortLeases.instance_name == PENDING_LEASE,
+            PortLeases.creation_date < cutoff,
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        return {"expired_reservations": reservations, "pending_ports": port_leases}
+
+    def remove_orphans(
+        self, docker_host: dict, containers: list, networks: list
+    ) -> None:
+        """
+        Remove the containers, then the networks, unknown in DB.
+        """
+        for container in containers:
+            self.app.logger.warning(
+                "Removing orphaned container '%s' on host '%s'.",
+                get_container_name(container),
+                docker_host["domain"],
+            )
+            if remove_container(self.app, docker_host["domain"], container):
+                release_ports(
+                    docker_host["domain"],
+                    get_container_host_ports(container),
+                )
+
+        for network in networks:
+            self.app.logger.warning(
+                "Removing orphaned network '%s' on host '%s'.",
+                network.name,
+                docker_host["domain"],
+            )
+            remove_network(self.app, docker_host["domain"], network)
+
+    def run(self) -> None:
+        while True:
+            self.wakeup.wait(timeout=self.interval)
+            self.wakeup.clear()
+
+            # Only the leader replica reconciles the hosts
+            if not LEADER.is_leader:
+                continue
+
+            with self.app.app_context():
+                try:
+                    result = self.reconcile()
+                except Exception as err:
+                    self.app.logger.error("Unable to reconcile the hosts: %s", err)
+                    db.session.rollback()
+                    result = {"error": str(err)}
+
+            with self.lock:
+                self.last_run = datetime.utcnow()
+                self.last_result = result
+
+    def stats(self) -> dict:
+        """
+        Returns what the last run removed.
+        """
+        with self.lock:
+            return {"last_run": self.last_run, **self.last_result}
+
+
+RECONCILER = DockerReconciler()
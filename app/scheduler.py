@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+from collections import defaultdict
+from threading import Lock
+from typing import Callable, Optional
+
+from flask import current_app
+
+from app.config import (
+    CHALLENGES_CATALOG,
+    DOCKER_HOSTS,
+    MAX_INSTANCE_COUNT,
+    PLACEMENT_STRATEGY,
+    ChallengeTemplate,
+    parse_memory,
+)
+from app.counters import COUNTERS
+from app.hosts import HOSTS
+from app.images import IMAGE_WARMER
+
+# Resources of the deployments selected but not yet saved in DB
+PENDING = defaultdict(lambda: {"instances": 0, "memory": 0, "cpus": 0.0})
+PENDING_LOCK = Lock()
+
+
+def get_hosts_load() -> dict:
+    """
+    Returns the resources used on each challenge host, from the live counters.
+    """
+    load = {
+        docker_host["domain"]: {
+            "instances": 0,
+            "memory": 0,
+            "cpus": 0.0,
+            "challenges": {},
+        }
+        for docker_host in DOCKER_HOSTS
+    }
+
+    host_deployments = COUNTERS.get_host_deployments()
+    for (host_domain, challenge_name), deployments in host_deployments.items():
+        if host_domain not in load:
+            continue
+
+        challenge = CHALLENGES_CATALOG.get(challenge_name)
+        if challenge is None:
+            continue
+
+        for key in ["instances", "memory", "cpus"]:
+            load[host_domain][key] += deployments * challenge.resources[key]
+        load[host_domain]["challenges"][challenge_name] = deployments
+
+    return load
+
+
+def get_host_capacity(docker_host: dict) -> dict:
+    """
+    Returns the capacity of a host configured in config.json (None = unlimited).
+    """
+    return {
+        "instances": docker_host.get("max_instances"),
+        "memory": (
+            parse_memory(docker_host["max_memory"])
+            if docker_host.get("max_memory")
+            else None
+        ),
+        "cpus": docker_host.get("max_cpus"),
+    }
+
+
+def get_usage(load: dict, capacity: dict, resources: dict) -> float:
+    """
+    Returns the highest usage ratio of a host once the deployment is placed.
+    """
+    # Without capacity, the instances are compared to the global limit
+    ratios = [
+        (load["instances"] + resources["instances"])
+        / (capacity["instances"] or MAX_INSTANCE_COUNT)
+    ]
+    ratios += [
+        (load[key] + resources[key]) / capacity[key]
+        for key in ["memory", "cpus"]
+        if capacity[key]
+    ]
+    return max(ratios)
+
+
+def least_loaded(candidates: list[tuple[dict, dict, float]], challenge_name: str):
+    """
+    Place the deployment on the host with the lowest usage.
+    """
+    return min(candidates, key=lambda candidate: candidate[2])[0]
+
+
+def bin_packing(candidates: list[tuple[dict, dict, float]], challenge_name: str):
+    """
+    Place the deployment on the most used host that can still host it.
+    """
+    return max(candidates, key=lambda candidate: candidate[2])[0]
+
+
+def spread(candidates: list[tuple[dict, dict, float]], challenge_name: str):
+    """
+    Place the deployment on the host running the fewest instances of the challenge.
+    """
+    return min(
+        candidates,
+        key=lambda candidate: (
+            candidate[1]["challenges"].get(challenge_name, 0),
+            candidate[2],
+        ),
+    )[0]
+
+
+STRATEGIES: dict[str, Callable] = {
+    "least_loaded": least_loaded,
+    "bin_packing": bin_packing,
+    "spread": spread,
+}
+
+if PLACEMENT_STRATEGY not in STRATEGIES:
+    raise ValueError(
+        f"Unknown placement strategy '{PLACEMENT_STRATEGY}' (available: {', '.join(STRATEGIES)})."
+    )
+
+
+def select_host(
+    challenge: ChallengeTemplate, strategy: Optional[str] = None
+) -> Optional[dict]:
+    """
+    Select the challenge host of a new deployment, returns None if all hosts are full
+    or unavailable. The caller must call `end_placement` once the deployment is saved (or failed).
+    """
+    resources = challenge.resources
+    load = get_hosts_load()
+
+    with PENDING_LOCK:
+        candidates = []
+        for docker_host in HOSTS.get_available_hosts():
+            host_load = load[docker_host["domain"]]
+            for key in ["instances", "memory", "cpus"]:
+                host_load[key] += PENDING[docker_host["domain"]][key]
+
+            capacity = get_host_capacity(docker_host)
+            if any(
+                capacity[key] and host_load[key] + resources[key] > capacity[key]
+                for key in ["instances", "memory", "cpus"]
+            ):
+                continue
+            candidates.append(
+                (docker_host, host_load, get_usage(host_load, capacity, resources))
+            )
+
+        # Prefer the hosts that already have the images of the challenge
+        candidates = [
+            candidate
+            for candidate in candidates
+            if IMAGE_WARMER.has_images(candidate[0]["domain"], challenge.images)
+        ] or candidates
+
+        if not candidates:
+            current_app.logger.error(
+                "No available challenge host has enough capacity for '%s'.",
+                challenge.name,
+            )
+            return None
+
+        docker_host = STRATEGIES[strategy or PLACEMENT_STRATEGY](
+            candidates, challenge.name
+        )
+        for key in ["instances", "memory", "cpus"]:
+            PENDING[docker_host["domain"]][key] += resources[key]
+
+    return docker_host
+
+
+def end_placement(docker_host: dict, challenge: ChallengeTemplate) -> None:
+    """
+    Forget the pending resources of a deployment.
+    """
+    with PENDING_LOCK:
+        for key in ["instances", "memory", "cpus"]:
+            PENDING[docker_host["domain"]][key] -= challenge.resources[key]
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+import secrets
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+
+from docker.errors import APIError, NotFound
+from flask import Flask
+
+from app.admission import ADMISSION
+from app.cluster import db_lock
+from app.config import DOCKER_HOSTS, TEARDOWN_THREADS
+from app.counters import COUNTERS
+from app.database import db
+from app.events import EVENTS
+from app.hosts import HOSTS
+from app.models import Deployments, Instances
+from app.ports import release_instances_ports
+
+
+class TeardownJob:
+    """
+    Progress of a bulk teardown.
+    """
+
+    def __init__(self):
+        self.id = secrets.token_hex(8)
+        self.total = 0
+        self.removed = 0
+        self.errors = 0
+        self.status = "running"
+        self.start_date = datetime.utcnow()
+        self.end_date = None
+        self.lock = Lock()
+
+    def step(self, success: bool = True) -> None:
+        with self.lock:
+            self.removed += 1
+            if not success:
+                self.errors += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "total": self.total,
+            "removed": self.removed,
+            "errors": self.errors,
+            "start_date": self.start_date,
+            "end_date": self.end_date,
+        }
+
+
+TEARDOWN_JOBS: dict[str, TeardownJob] = {}
+
+# Deployments being removed, a deployment is never torn down twice concurrently
+# (reaper, admin, docker events) so that its counters are decremented once
+TEARDOWN_NETWORKS: set[str] = set()
+TEARDOWN_LOCK = Lock()
+
+# Names per filtered containers.list call, the filters are sent in the URL
+LIST_CHUNK_SIZE = 100
+
+
+def is_tearing_down(network_name: str) -> bool:
+    with TEARDOWN_LOCK:
+        return network_name in TEARDOWN_NETWORKS
+
+
+def get_container_name(container) -> str:
+    """
+    Name of a container, from the sparse listing or the inspect data.
+    """
+    names = container.attrs.get("Names")
+    return names[0].lstrip("/") if names else container.name
+
+
+def list_containers(client, instance_names: list[str]) -> list:
+    """
+    Sparse listing of the containers of a host by name, without an inspect per
+    container. The `name` filter of the daemon is a substring match, the names
+    are checked again.
+    """
+    wanted = set(instance_names)
+    containers = []
+    for start in range(0, len(instance_names), LIST_CHUNK_SIZE):
+        containers += client.containers.list(
+            all=True,
+            sparse=True,
+            filters={"name": instance_names[start : start + LIST_CHUNK_SIZE]},
+        )
+    return [
+        container for container in containers if get_container_name(container) in wanted
+    ]
+
+
+def remove_container(app: Flask, host_domain: str, container) -> bool:
+    """
+    Force remove a docker container, returns False on error.
+    """
+    try:
+        with ADMISSION.host_operation(host_domain), HOSTS.call(
+            host_domain, "containers.remove"
+        ):
+            container.remove(force=True)
+    except NotFound:
+        pass
+    except APIError as err:
+        app.logger.warning(
+            "Unable to remove the container (name: '%s'): %s",
+            get_container_name(container),
+            err,
+        )
+        return False
+    return True
+
+
+def teardown_host(
+    app: Flask, docker_host: dict, deployments: list[Deployments], job: TeardownJob
+) -> None:
+    """
+    Remove the deployments running on the same host: all their containers are force
+    removed concurrently, then each network is removed exactly once.
+    """
+    client = docker_host["client"]
+    instance_names = {
+        instance.instance_name
+        for deployment in deployments
+        for instance in deployment.instances
+    }
+    network_names = {deployment.network_name for deployment in deployments}
+
+    # Do not wait for the timeouts of a host known to be down
+    if HOSTS.is_down(docker_host["domain"]):
+        app.logger.error(
+            "Challenge host '%s' is unavailable, skipping the removal of %d containers.",
+            docker_host["domain"],
+            len(instance_names),
+        )
+        for _ in instance_names:
+            job.step(success=False)
+        return
+
+    try:
+        with HOSTS.call(docker_host["domain"], "containers.list"):
+            containers = list_containers(client, sorted(instance_names))
+    except Exception as err:
+        app.logger.error(
+            "Unable to list containers on host '%s': %s", docker_host["domain"], err
+        )
+        for _ in instance_names:
+            job.step(success=False)
+        return
+
+    # Instances already gone from the host
+    for _ in range(len(instance_names) - len(containers)):
+        job.step()
+
+    with ThreadPoolExecutor(
+        max_workers=TEARDOWN_THREADS, thread_name_prefix="teardown"
+    ) as executor:
+        for success in executor.map(
+            lambda container: remove_container(app, docker_host["domain"], container),
+            containers,
+        ):
+            job.step(success)
+
+        try:
+            with HOSTS.call(docker_host["domain"], "networks.list"):
+                networks = client.networks.list(names=list(network_names))
+        except Exception as err:
+            app.logger.error(
+                "Unable to list networks on host '%s': %s", docker_host["domain"], err
+            )
+            networks = []
+
+        list(
+            executor.map(
+                lambda network: remove_network(app, docker_host["domain"], network),
+                networks,
+            )
+        )
+
+
+def remove_network(app: Flask, host_domain: str, network) -> None:
+    """
+    Remove a docker network.
+    """
+    try:
+        with ADMISSION.host_operation(host_domain), HOSTS.call(
+            host_domain, "networks.remove"
+        ):
+            network.remove()
+    except (NotFound, APIError) as err:
+        app.logger.warning(
+            "Unable to remove the network (name: '%s'): %s", network.name, err
+        )
+
+
+def run_teardown(app: Flask, network_names: list[str], job: TeardownJob) -> None:
+    """
+    Remove deployments in parallel on each host, then delete them in DB at once.
+    """
+    with TEARDOWN_LOCK:
+        network_names = [
+            network_name
+            for network_name in network_names
+            if network_name not in TEARDOWN_NETWORKS
+        ]
+        TEARDOWN_NETWORKS.update(network_names)
+
+    with app.app_context():
+        try:
+            deployments = Deployments.query.filter(
+                Deployments.network_name.in_(network_names)
+            ).all()
+            job.total = sum(len(deployment.instances) for deployment in deployments)
+
+            per_host = defaultdict(list)
+            for deployment in deployments:
+                per_host[deployment.host_domain].append(deployment)
+
+            docker_hosts = {
+                docker_host["domain"]: docker_host for docker_host in DOCKER_HOSTS
+            }
+            for host_domain in set(per_host) - set(docker_hosts):
+                app.logger.warning("Unknown challenge host '%s'.", host_domain)
+                for deployment in per_host.pop(host_domain):
+                    for _ in deployment.instances:
+                        job.step(success=False)
+
+            with ThreadPoolExecutor(
+                max_workers=max(len(per_host), 1), thread_name_prefix="teardown"
+            ) as executor:
+                list(
+                    executor.map(
+                        lambda host_domain: teardown_host(
+                            app,
+                            docker_hosts[host_domain],
+                            per_host[host_domain],
+                            job,
+                        ),
+                        per_host,
+                    )
+                )
+
+            removed = {
+                deployment.id: (
+                    deployment.network_name,
+                    deployment.team_id,
+                    deployment.host_domain,
+                    deployment.challenge_name,
+                    [instance.instance_name for instance in deployment.instances],
+                )
+                for deployment in deployments
+            }
+            with COUNTERS.changing():
+                # Another replica may have removed some of the deployments meanwhile
+                # (docker events of the leader), only the rows still there are
+                # counted and notified
+                with db_lock("teardown"):
+                    deleted = [
+                        deployment_id
+                        for (deployment_id,) in db.session.query(Deployments.id).filter(
+                            Deployments.id.in_(list(removed))
+                        )
+                    ]
+                    release_instances_ports(
+                        [
+                            (removed[deployment_id][2], instance_name)
+                            for deployment_id in deleted
+                            for instance_name in removed[deployment_id][4]
+                        ]
+                    )
+                    Instances.query.filter(Instances.deployment_id.in_(deleted)).delete(
+                        synchronize_session=False
+                    )
+                    Deployments.query.filter(Deployments.id.in_(deleted)).delete(
+                        synchronize_session=False
+                    )
+                for deployment_id in deleted:
+                    _, team_id, host_domain, challenge_name, instance_names = removed[
+                        deployment_id
+                    ]
+                    COUNTERS.remove(
+                        team_id, host_domain, challenge_name, len(instance_names)
+                    )
+            for deployment_id in deleted:
+                network_name, team_id, _, challenge_name, _ = removed[deployment_id]
+                EVENTS.publish(
+                    "removed",
+                    team_id,
+                    network_name=network_name,
+                    challenge_name=challenge_name,
+                )
+            job.status = "done"
+        except Exception as err:
+            app.logger.error("Unable to remove deployments: %s", err)
+            db.session.rollback()
+            job.status = "failed"
+        finally:
+            with TEARDOWN_LOCK:
+                TEARDOWN_NETWORKS.difference_update(network_names)
+
+        job.end_date = datetime.utcnow()
+
+
+def start_teardown(app: Flask, network_names: list[str]) -> TeardownJob:
+    """
+    Remove deployments in a background thread, returns the job to follow its progress.
+    """
+    expired = datetime.utcnow() - timedelta(hours=1)
+    for job_id, old_job in list(TEARDOWN_JOBS.items()):
+        if old_job.end_date and old_job.end_date < expired:
+            TEARDOWN_JOBS.pop(job_id, None)
+
+    job = TeardownJob()
+    TEARDOWN_JOBS[job.id] = job
+    Thread(
+        target=run_teardown,
+        args=(app, network_names, job),
+        name="teardown",
+        daemon=True,
+    ).start()
+    return job
+
+
+def remove_deployments(app: Flask, network_names: list[str]) -> TeardownJob:
+    """
+    Remove deployments and wait for the end of the teardown.
+    """
+    job = TeardownJob()
+    run_teardown(app, network_names, job)
+    return job
+
+
+def remove_all_instances(app: Flask) -> TeardownJob:
+    """
+    Remove all running deployments.
+    """
+    return start_teardown(
+        app,
+        [
+            network_name
+            for (network_name,) in db.session.query(Deployments.network_name)
+        ],
+    )
@@ -1,122 +1,250 @@
 #!/usr/bin/env python3
-import random
 import re
 import secrets
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Callable, Optional
 
-import requests
 from docker.errors import APIError, ImageNotFound, NotFound
-from flask import current_app
-from flask.sessions import SessionMixin
+from flask import Flask, current_app
+from sqlalchemy import or_
 
+from app.admission import ADMISSION
 from app.config import (
-    CHALLENGES,
-    CTFD_URL,
+    CHALLENGES_CATALOG,
+    DEPLOY_THREADS,
     DOCKER_HOSTS,
+    INSTANCE_EXTENSION,
     MAX_INSTANCE_DURATION,
-    MAX_PORTS,
-    MIN_PORTS,
+    MAX_INSTANCE_EXTENSIONS,
+    ChallengeTemplate,
+    ContainerTemplate,
 )
+from app.counters import COUNTERS, Reservation
+from app.ctfd import CTFD_CLIENT
 from app.database import db
-from app.models import Instances
+from app.events import EVENTS
+from app.hosts import HOSTS
+from app.images import IMAGE_WARMER
+from app.metrics import ACCESS_KEY_SECONDS, DEPLOY_STAGE_SECONDS
+from app.models import Deployments, Instances
+from app.ports import allocate_ports, lease_ports, release_ports
+from app.reaper import REAPER
+from app.scheduler import end_placement, select_host
+from app.teardown import remove_container, remove_deployments
+
+DEPLOY_EXECUTOR = ThreadPoolExecutor(
+    max_workers=DEPLOY_THREADS, thread_name_prefix="deploy"
+)
+
+# Labels of the containers and networks created by the app
+LABEL_PREFIX = "fr.heroctf.deployer"
+MANAGED_LABEL = f"{LABEL_PREFIX}.managed"
+
+# Clock skew tolerated between the app and the challenge hosts
+RESET_EVENTS_GRACE = timedelta(seconds=5)
+# A reset still in progress after this delay was interrupted (stopped replica)
+RESET_TIMEOUT = timedelta(minutes=10)
 
 
-def remove_old_instances():
+def get_deployment_labels(
+    network_name: str, team_id: int, challenge_name: str, deadline: datetime
+) -> dict:
     """
-    Remove old instances (creation_date > X minutes).
+    Labels of the docker objects of a deployment, the team and the expiry are the
+    ones of the creation (a pooled deployment is claimed later).
     """
-    instances = (
-        db.session.query(Instances)
-        .filter(
-            Instances.creation_date
-            < datetime.utcnow() - timedelta(minutes=MAX_INSTANCE_DURATION)
-        )
-        .all()
-    )
-
-    # TODO: Remove all instances of a challenge.
-    for instance in instances:
-        remove_container_by_id(instance.id)
+    return {
+        MANAGED_LABEL: "true",
+        f"{LABEL_PREFIX}.deployment": network_name,
+        f"{LABEL_PREFIX}.team": str(team_id),
+        f"{LABEL_PREFIX}.challenge": challenge_name,
+        f"{LABEL_PREFIX}.created": str(int(datetime.utcnow().timestamp())),
+        f"{LABEL_PREFIX}.expires": deadline.isoformat(timespec="seconds"),
+    }
 
 
 def remove_user_running_instance(user_id):
     """
-    Remove instance if the user has already run an instance.
+    Remove the deployments of the user if they have already run an instance.
     """
-    instances = Instances.query.filter_by(user_id=user_id).all()
+    network_names = [
+        network_name
+        for (network_name,) in db.session.query(Deployments.network_name).filter_by(
+            user_id=user_id
+        )
+    ]
 
-    for instance in instances:
+    for network_name in network_names:
         current_app.logger.debug(
-            "User n°%d is removing '%s'...", user_id, instance.instance_name
+            "User n°%d is removing deployment '%s'...", user_id, network_name
         )
-        remove_container_by_id(instance.id)
 
-    return len(instances) > 0
+    if network_names:
+        remove_deployments(current_app._get_current_object(), network_names)
+
+    return len(network_names) > 0
 
 
-def find_ip_address(container):
+def find_ip_addresses(docker_host: dict, network, containers: list) -> list[str]:
     """
-    Find IP address of a running container.
+    Find the IP address of the containers of a deployment. The containers returned
+    by `containers.run` were inspected before their start, without an address: the
+    network is inspected once, a container missing from its endpoints is inspected
+    again.
     """
-    ret = container.exec_run("hostname -i")
-    if ret.exit_code == 0:
-        return ret.output.decode().strip()
+    try:
+        with HOSTS.call(docker_host["domain"], "networks.inspect"):
+            network.reload()
+        endpoints = {
+            endpoint["Name"]: endpoint["IPv4Address"].split("/")[0]
+            for endpoint in network.attrs.get("Containers", {}).values()
+        }
+    except (NotFound, APIError, KeyError) as err:
+        current_app.logger.warning(
+            "Unable to inspect the network (name: '%s'): %s", network.name, err
+        )
+        endpoints = {}
+
+    ip_addresses = []
+    for container in containers:
+        ip_address = endpoints.get(container.name)
+        if not ip_address:
+            try:
+                with HOSTS.call(docker_host["domain"], "containers.inspect"):
+                    container.reload()
+                ip_address = (
+                    container.attrs.get("NetworkSettings", {})
+                    .get("Networks", {})
+                    .get(network.name, {})
+                    .get("IPAddress")
+                )
+            except (NotFound, APIError) as err:
+                current_app.logger.warning(
+                    "Unable to inspect the container (name: '%s'): %s",
+                    container.name,
+                    err,
+                )
+        ip_addresses.append(ip_address or "UNKNOWN")
 
-    ret = container.exec_run("cat /etc/hosts")
-    if ret.exit_code == 0:
-        return ret.output.split()[-2].decode()
+    return ip_addresses
 
-    return "UNKNOWN"
 
+def create_instances(
+    session: dict,
+    challenge: ChallengeTemplate,
+    on_status: Optional[Callable[[str, Optional[str]], None]] = None,
+    strategy: Optional[str] = None,
+    reservation: Optional[Reservation] = None,
+) -> int:
+    """
+    Create new instances, `on_status` is called at each step of the deployment.
+    The capacity held by `reservation` is released if the deployment fails.
+    """
+    on_status = on_status or (lambda status, message=None: None)
 
-def create_instances(session: SessionMixin, challenge_info: dict) -> int:
+    EVENTS.publish(
+        "starting",
+        session["team_id"],
+        user_id=session["user_id"],
+        challenge_name=challenge.name,
+    )
+
+    nb_container = 0
+    with DEPLOY_STAGE_SECONDS.time(stage="placement"):
+        docker_host = select_host(challenge, strategy)
+    if docker_host is not None:
+        try:
+            nb_container = deploy_instances(
+                session, challenge, docker_host, on_status, reservation
+            )
+        finally:
+            end_placement(docker_host, challenge)
+    COUNTERS.release(reservation)
+
+    if not nb_container:
+        EVENTS.publish(
+            "failed",
+            session["team_id"],
+            user_id=session["user_id"],
+            challenge_name=challenge.name,
+        )
+    return nb_container
+
+
+def deploy_instances(
+    session: dict,
+    challenge: ChallengeTemplate,
+    docker_host: dict,
+    on_status: Callable[[str, Optional[str]], None],
+    reservation: Optional[Reservation] = None,
+) -> int:
     """
-    Create new instances.
+    Deploy the containers of a challenge on a challenge host.
     """
     # Generate deploy environment
+    network_name = secrets.token_hex(16)
+    deadline = datetime.utcnow() + timedelta(minutes=MAX_INSTANCE_DURATION)
     deploy_config = {
-        "network_name": secrets.token_hex(16),
-        "host": random.choice(DOCKER_HOSTS),
+        "network_name": network_name,
+        "host": docker_host,
         "containers": [],
+        "labels": get_deployment_labels(
+            network_name, session["team_id"], challenge.name, deadline
+        ),
     }
     worker = deploy_config["host"]["client"]
-    worker.networks.create(deploy_config["network_name"], driver="bridge")
+
+    on_status("pulling", f"Pulling images of {challenge.name}...")
+    try:
+        with DEPLOY_STAGE_SECONDS.time(stage="pull"):
+            IMAGE_WARMER.ensure_images(docker_host, challenge.images)
+    except (ImageNotFound, APIError) as err:
+        current_app.logger.error("ImageNotFound: Unable to pull images, %s", err)
+        return 0
+
+    on_status("starting", f"Starting containers of {challenge.name}...")
+
+    # Reserve all the ports of the deployment at once
+    with DEPLOY_STAGE_SECONDS.time(stage="ports"):
+        host_ports = allocate_ports(
+            deploy_config["host"]["domain"], challenge.ports_count
+        )
+    if host_ports is None:
+        return 0
+
+    try:
+        with DEPLOY_STAGE_SECONDS.time(stage="network"), ADMISSION.host_operation(
+            docker_host["domain"]
+        ), HOSTS.call(docker_host["domain"], "networks.create"):
+            network = worker.networks.create(
+                deploy_config["network_name"],
+                driver="bridge",
+                labels=deploy_config["labels"],
+            )
+    except Exception as err:
+        current_app.logger.error(
+            "Unable to create network '%s': %s", deploy_config["network_name"], err
+        )
+        release_ports(deploy_config["host"]["domain"], host_ports)
+        return 0
     current_app.logger.debug(
         "Starting deployment '%s' for challenge '%s'.",
         deploy_config["network_name"],
-        challenge_info["name"],
+        challenge.name,
     )
 
-    # Generate containers environment
-    for container in challenge_info["containers"]:
-        instance_name = secrets.token_hex(16)
-        ports = {
-            pinfo["port"]: find_unused_port(deploy_config["host"])
-            for pinfo in container["ports"]
-        }
-        environment = container.get("environment", {})
-        environment["DEPLOY_HOST"] = deploy_config["host"]["domain"]
-        environment["DEPLOY_PORTS"] = ",".join(f"{p}->{ports[p]}" for p in ports)
-
+    # Only the values specific to this deployment are generated
+    for container in challenge.containers:
+        ports = {port: host_ports.pop() for port, _ in container.ports}
         deploy_config["containers"].append(
-            {
-                "docker_image": container["docker_image"],
-                "command": container.get("command", None),
-                "hostname": container.get("hostname", instance_name),
-                "instance_name": instance_name,
-                "ports": ports,
-                "protocols": [pinfo["protocol"] for pinfo in container["ports"]],
-                "environment": environment,
-                "tmpfs": container.get("tmpfs", {}),
-                "mem_limit": container.get("mem_limit", "512m"),
-                "privileged": container.get("privileged", False),
-                "read_only": container.get("read_only", False),
-                "cpu_period": container.get("cpu_period", None),
-                "cpu_quota": container.get("cpu_quota", None),
-                "cap_add": container.get("cap_add", []),
-                "cap_drop": container.get("cap_drop", []),
-            }
+            get_container_config(
+                docker_host,
+                container,
+                secrets.token_hex(16),
+                ports,
+                deploy_config["labels"],
+            )
         )
 
     current_app.logger.debug(
@@ -125,124 +253,403 @@ def create_instances(session: SessionMixin, challenge_info: dict) -> int:
         deploy_config,
     )
 
-    # Save instances in DB and run containers
-    for container in deploy_config["containers"]:
-        instance = Instances(
-            user_id=session["user_id"],
-            user_name=session["user_name"],
-            team_id=session["team_id"],
-            team_name=session["team_name"],
-            docker_image=container["docker_image"],
-            challenge_name=challenge_info["name"],
-            network_name=deploy_config["network_name"],
-            hostname=container["hostname"],
-            ports=", ".join(
-                f"{port}/{proto}"
-                for port, proto in zip(
-                    container["ports"].values(), container["protocols"]
-                )
-            ),
-            host_domain=deploy_config["host"]["domain"],
-            instance_name=container["instance_name"],
+    # Run containers concurrently
+    futures = [
+        DEPLOY_EXECUTOR.submit(
+            start_container, docker_host, deploy_config["network_name"], container
         )
+        for container in deploy_config["containers"]
+    ]
+    wait(futures)
 
+    started, failed = [], False
+    for container, future in zip(deploy_config["containers"], futures):
         try:
-            container = worker.containers.run(
-                image=container["docker_image"],
-                command=container["command"],
-                hostname=container["hostname"],
-                name=container["instance_name"],
-                ports=container["ports"],
-                environment=container["environment"],
-                tmpfs=container["tmpfs"],
-                network=deploy_config["network_name"],
-                auto_remove=True,
-                detach=True,
-                mem_limit=container["mem_limit"],
-                privileged=container["privileged"],
-                read_only=container["read_only"],
-                cpu_period=container["cpu_period"],
-                cpu_quota=container["cpu_quota"],
-                cap_add=container["cap_add"],
-                cap_drop=container["cap_drop"],
-            )
-            instance.ip_address = find_ip_address(container)
+            started.append(future.result())
         except ImageNotFound as err:
             current_app.logger.error(
                 "ImageNotFound: Unable to find %s, %s", container["docker_image"], err
             )
-            return 0
+            failed = True
+        except Exception as err:
+            current_app.logger.error(
+                "Unable to start container '%s' (image: %s): %s",
+                container["instance_name"],
+                container["docker_image"],
+                err,
+            )
+            failed = True
 
-        db.session.add(instance)
-        db.session.commit()
+    # Save all instances in DB in a single transaction
+    if not failed:
+        try:
+            with DEPLOY_STAGE_SECONDS.time(stage="ip_discovery"):
+                ip_addresses = find_ip_addresses(docker_host, network, started)
+            deployment = Deployments(
+                user_id=session["user_id"],
+                user_name=session["user_name"],
+                team_id=session["team_id"],
+                team_name=session["team_name"],
+                challenge_name=challenge.name,
+                network_name=deploy_config["network_name"],
+                host_domain=deploy_config["host"]["domain"],
+                deadline=deadline,
+            )
+            for container, ip_address in zip(deploy_config["containers"], ip_addresses):
+                deployment.instances.append(
+                    Instances(
+                        docker_image=container["docker_image"],
+                        hostname=container["hostname"],
+                        ip_address=ip_address,
+                        ports=", ".join(
+                            f"{port}/{proto}"
+                            for port, proto in zip(
+                                container["ports"].values(), container["protocols"]
+                            )
+                        ),
+                        instance_name=container["instance_name"],
+                    )
+                )
+                lease_ports(
+                    deploy_config["host"]["domain"],
+                    container["instance_name"],
+                    list(container["ports"].values()),
+                )
+            with COUNTERS.changing():
+                with DEPLOY_STAGE_SECONDS.time(stage="db_commit"):
+                    db.session.add(deployment)
+                    db.session.commit()
+                COUNTERS.add(
+                    session["team_id"],
+                    deploy_config["host"]["domain"],
+                    challenge.name,
+                    len(deploy_config["containers"]),
+                    reservation,
+                )
+            EVENTS.publish(
+                "ready",
+                session["team_id"],
+                user_id=session["user_id"],
+                challenge_name=challenge.name,
+                network_name=deploy_config["network_name"],
+            )
+        except Exception as err:
+            current_app.logger.error(
+                "Unable to save deployment '%s': %s", deploy_config["network_name"], err
+            )
+            db.session.rollback()
+            failed = True
+
+    if failed:
+        rollback_deployment(deploy_config, network, started)
+        return 0
+
+    return len(challenge.containers)
+
+
+def get_container_config(
+    docker_host: dict,
+    container: ContainerTemplate,
+    instance_name: str,
+    ports: dict[str, int],
+    labels: dict,
+) -> dict:
+    """
+    Run configuration of a container of a deployment.
+    """
+    environment = dict(container.environment)
+    environment["DEPLOY_HOST"] = docker_host["domain"]
+    environment["DEPLOY_PORTS"] = ",".join(f"{p}->{ports[p]}" for p in ports)
+
+    return {
+        "docker_image": container.docker_image,
+        "hostname": container.hostname or instance_name,
+        "instance_name": instance_name,
+        "ports": ports,
+        "protocols": [protocol for _, protocol in container.ports],
+        "environment": environment,
+        "labels": labels,
+        "options": container.run_options(),
+    }
+
+
+def start_container(docker_host: dict, network_name: str, container: dict):
+    """
+    Run a container of a deployment.
+    """
+    with DEPLOY_STAGE_SECONDS.time(stage="containers_run"), ADMISSION.host_operation(
+        docker_host["domain"]
+    ), HOSTS.call(docker_host["domain"], "containers.run"):
+        docker_container = docker_host["client"].containers.run(
+            **container["options"],
+            hostname=container["hostname"],
+            name=container["instance_name"],
+            ports=container["ports"],
+            environment=container["environment"],
+            labels=container["labels"],
+            network=network_name,
+            auto_remove=True,
+            detach=True,
+        )
+    return docker_container
 
-    return len(challenge_info["containers"])
 
+def rollback_deployment(deploy_config: dict, network, containers: list) -> None:
+    """
+    Tear down a partially started deployment and free its ports.
+    """
+    current_app.logger.warning(
+        "Rolling back deployment '%s'...", deploy_config["network_name"]
+    )
 
-def get_challenge_count_per_team(team_id: int) -> int:
+    for container in containers:
+        try:
+            with ADMISSION.host_operation(deploy_config["host"]["domain"]), HOSTS.call(
+                deploy_config["host"]["domain"], "containers.remove"
+            ):
+                container.remove(force=True)
+        except (NotFound, APIError) as err:
+            current_app.logger.warning(
+                "Unable to remove the container (name: '%s'): %s", container.name, err
+            )
+
+    try:
+        with ADMISSION.host_operation(deploy_config["host"]["domain"]), HOSTS.call(
+            deploy_config["host"]["domain"], "networks.remove"
+        ):
+            network.remove()
+    except (NotFound, APIError) as err:
+        current_app.logger.warning(
+            "Unable to remove the network (name: '%s'): %s",
+            deploy_config["network_name"],
+            err,
+        )
+
+    for container in deploy_config["containers"]:
+        release_ports(
+            deploy_config["host"]["domain"], list(container["ports"].values())
+        )
+
+
+def is_resetting(
+    state: str, reset_date: Optional[datetime], timestamp: Optional[float] = None
+) -> bool:
     """
-    Returns the number of challenges running for a specific team.
+    Returns True while a deployment is being reset, or if `timestamp` (unix time of
+    a docker event) is during its last reset. The reset is saved in DB, the replica
+    following the docker events may not be the one resetting the deployment.
     """
-    return (
-        Instances.query.filter_by(team_id=team_id)
-        .distinct(Instances.network_name)
-        .count()
+    if reset_date is None:
+        return False
+    now = datetime.utcnow()
+    if state == "resetting":
+        return reset_date > now - RESET_TIMEOUT
+    event_date = now if timestamp is None else datetime.utcfromtimestamp(timestamp)
+    return event_date <= reset_date + RESET_EVENTS_GRACE
+
+
+def reset_deployment(deployment: Deployments) -> tuple[bool, str]:
+    """
+    Recreate the containers of a deployment in place: the network, the names, the
+    hostnames and the ports are kept, only the IP addresses are discovered again.
+    A deployment that cannot be restored once its containers are removed is torn
+    down.
+    """
+    app = current_app._get_current_object()
+    challenge = get_challenge_info(deployment.challenge_name)
+    docker_host = next(
+        (
+            docker_host
+            for docker_host in DOCKER_HOSTS
+            if docker_host["domain"] == deployment.host_domain
+        ),
+        None,
     )
+    if (
+        challenge is None
+        or docker_host is None
+        or len(challenge.containers) != len(deployment.instances)
+    ):
+        return False, "This instance cannot be reset, please redeploy it."
+    if not HOSTS.is_available(docker_host["domain"]):
+        return False, "The challenge host is unavailable, please retry later."
+
+    # Only one replica can flag the deployment, an interrupted reset times out
+    deployment_id = deployment.id
+    state = "running" if deployment.state == "resetting" else deployment.state
+    now = datetime.utcnow()
+    started = Deployments.query.filter(
+        Deployments.id == deployment_id,
+        or_(
+            Deployments.state != "resetting",
+            Deployments.reset_date.is_(None),
+            Deployments.reset_date < now - RESET_TIMEOUT,
+        ),
+    ).update({"state": "resetting", "reset_date": now}, synchronize_session=False)
+    db.session.commit()
+    if not started:
+        return False, "Your instance is already being reset."
+
+    success = False
+    try:
+        with DEPLOY_STAGE_SECONDS.time(stage="reset"):
+            success, message = recreate_containers(
+                app, docker_host, challenge, deployment
+            )
+    finally:
+        # The events of the replaced containers are ignored until a grace delay
+        Deployments.query.filter_by(id=deployment_id, state="resetting").update(
+            {
+                "state": "running" if success else state,
+                "reset_date": datetime.utcnow(),
+            },
+            synchronize_session=False,
+        )
+        db.session.commit()
+
+    if success:
+        EVENTS.publish(
+            "restarted",
+            deployment.team_id,
+            user_id=deployment.user_id,
+            challenge_name=challenge.name,
+            network_name=deployment.network_name,
+        )
+    return success, message
 
 
-def find_unused_port(docker_host) -> Optional[int]:
+def recreate_containers(
+    app: Flask, docker_host: dict, challenge: ChallengeTemplate, deployment: Deployments
+) -> tuple[bool, str]:
     """
-    Find a port that is not used by any instances (on a specific challenge host).
+    Replace the containers of a deployment by new ones with the same configuration.
     """
+    client = docker_host["client"]
+    labels = get_deployment_labels(
+        deployment.network_name,
+        deployment.team_id,
+        challenge.name,
+        deployment.deadline,
+    )
     containers = []
+    for container, instance in zip(challenge.containers, deployment.instances):
+        # Instances.ports: "<host port>/<protocol>, ..." in the order of the template
+        host_ports = [
+            int(port.split("/")[0])
+            for port in (instance.ports or "").split(", ")
+            if port
+        ]
+        ports = dict(zip((port for port, _ in container.ports), host_ports))
+        containers.append(
+            get_container_config(
+                docker_host, container, instance.instance_name, ports, labels
+            )
+        )
+
     try:
-        containers = docker_host["client"].containers.list()
+        IMAGE_WARMER.ensure_images(docker_host, challenge.images)
+        with HOSTS.call(docker_host["domain"], "networks.get"):
+            network = client.networks.get(deployment.network_name)
     except Exception as err:
-        current_app.logger.error(
-            "Unable to list containers on host '%s': %s", docker_host["domain"], err
+        app.logger.error(
+            "Unable to reset deployment '%s': %s", deployment.network_name, err
         )
-        return None
+        return False, "Unable to reset your instance, please retry later."
 
-    found = False
-    while not found:
-        found = True
-        rand_port = random.randint(MIN_PORTS, MAX_PORTS + 1)
+    try:
+        for instance in deployment.instances:
+            try:
+                with HOSTS.call(docker_host["domain"], "containers.get"):
+                    old_container = client.containers.get(instance.instance_name)
+            except NotFound:
+                continue
+            if not remove_container(app, docker_host["domain"], old_container):
+                raise RuntimeError(f"unable to remove '{instance.instance_name}'")
+
+        futures = [
+            DEPLOY_EXECUTOR.submit(
+                start_container, docker_host, deployment.network_name, container
+            )
+            for container in containers
+        ]
+        wait(futures)
+        started = [future.result() for future in futures]
+
+        ip_addresses = find_ip_addresses(docker_host, network, started)
+        for instance, ip_address in zip(deployment.instances, ip_addresses):
+            instance.ip_address = ip_address
+        db.session.commit()
+    except Exception as err:
+        app.logger.error(
+            "Unable to reset deployment '%s', removing it: %s",
+            deployment.network_name,
+            err,
+        )
+        db.session.rollback()
+        remove_deployments(app, [deployment.network_name])
+        return False, "Unable to reset your instance, it was removed."
 
-        for container in containers:
-            if rand_port in container.ports.values():
-                found = False
+    return True, "Instance reset successfully."
 
-        if found:
-            return rand_port
 
-    return None
+def extend_deployment(deployment: Deployments) -> tuple[bool, str]:
+    """
+    Move the deadline of a deployment by INSTANCE_EXTENSION minutes, at most
+    MAX_INSTANCE_EXTENSIONS times. The update is conditional so that concurrent
+    requests cannot exceed the quota.
+    """
+    if deployment.deadline <= datetime.utcnow():
+        return False, "Your instance has expired."
+    if deployment.extensions >= MAX_INSTANCE_EXTENSIONS:
+        return (
+            False,
+            f"Your instance cannot be extended more than {MAX_INSTANCE_EXTENSIONS} times.",
+        )
+
+    deadline = deployment.deadline + timedelta(minutes=INSTANCE_EXTENSION)
+    updated = Deployments.query.filter(
+        Deployments.id == deployment.id,
+        Deployments.deadline == deployment.deadline,
+        Deployments.extensions < MAX_INSTANCE_EXTENSIONS,
+    ).update(
+        {"deadline": deadline, "extensions": Deployments.extensions + 1},
+        synchronize_session=False,
+    )
+    db.session.commit()
+    if not updated:
+        return False, "Your instance was modified in the meantime, please retry."
+
+    REAPER.schedule(deployment.network_name, deadline)
+    EVENTS.publish(
+        "extended",
+        deployment.team_id,
+        user_id=deployment.user_id,
+        challenge_name=deployment.challenge_name,
+        network_name=deployment.network_name,
+        deadline=deadline.isoformat() + "Z",
+    )
+    return True, f"Your instance was extended by {INSTANCE_EXTENSION} minutes."
 
 
 def get_total_instance_count() -> int:
     """
     Returns the number of challenges instance running.
     """
-    return Instances.query.count()
+    return COUNTERS.total
 
 
-def get_challenge_info(challenge_name: str) -> Optional[dict]:
+def get_challenge_info(challenge_name: str) -> Optional[ChallengeTemplate]:
     """
     Returns challenge information with a challenge_name as parameter.
     """
-    for challenge in CHALLENGES:
-        if challenge["name"] == challenge_name:
-            return challenge
-    return None
+    return CHALLENGES_CATALOG.get(challenge_name)
 
 
 def check_challenge_name(challenge_name):
     """
     Returns True if the challenge_name is valid, else False.
     """
-    for challenge in CHALLENGES:
-        if challenge["name"] == challenge_name:
-            return True
-    return False
+    return challenge_name in CHALLENGES_CATALOG
 
 
 def check_access_key(key: str) -> tuple[bool, str, dict]:
@@ -273,105 +680,11 @@ def check_access_key(key: str) -> tuple[bool, str, dict]:
     if not re.match(pattern, key):
         return False, "Invalid access key, wrong format!", user
 
-    base_url = CTFD_URL.strip("/")
     try:
-        resp_json = requests.get(
-            f"{base_url}/api/v1/users/me",
-            headers={
-                "Authorization": f"Token {key}",
-                "Content-Type": "application/json",
-            },
-        ).json()
-
-        success = resp_json.get("success", False)
-        user["user_id"] = resp_json.get("data", {}).get("id", "")
-        user["username"] = resp_json.get("data", {}).get("name", "")
-        user["team_id"] = resp_json.get("data", {}).get("team_id", False)
-
-        # User is not in a team
-        if not success or not user["team_id"]:
-            return False, "User not in a team or invalid token.", user
-
-        resp_json = requests.get(
-            f"{base_url}/api/v1/teams/{user['team_id']}",
-            headers={
-                "Authorization": f"Token {key}",
-                "Content-Type": "application/json",
-            },
-        ).json()
-        user["team_name"] = resp_json.get("data", {}).get("name", "")
-
-        resp_json = requests.get(
-            f"{base_url}/api/v1/configs",
-            headers={
-                "Authorization": f"Token {key}",
-                "Content-Type": "application/json",
-            },
-        ).json()
-        user["is_admin"] = resp_json.get("success", False)
-        return True, "", user
+        with ACCESS_KEY_SECONDS.time():
+            return CTFD_CLIENT.get_identity(key)
     except Exception as err:
         current_app.logger.error("Unable to reach CTFd with access key: %s", key)
         current_app.logger.error("Error: %s", str(err))
 
     return False, "An error has occured.", user
-
-
-def remove_all_instances():
-    """
-    Remove all running containers.
-    """
-    for instance in Instances.query.all():
-        remove_container_by_id(instance.id)
-
-
-def remove_container_by_name(host_domain: str, name: str) -> None:
-    """
-    Remove running container using its random name.
-    """
-    for docker_host in DOCKER_HOSTS:
-        if host_domain in docker_host["domain"]:
-            client = docker_host["client"]
-            containers = client.containers.list(filters={"name": name})
-
-            if len(containers):
-                current_app.logger.debug("Removing container '%s'...", name)
-                network_name = "UNKNOWN"
-                try:
-                    containers[0].remove(force=True)
-
-                    network_name = list(
-                        containers[0].attrs["NetworkSettings"]["Networks"].keys()
-                    )[0]
-                    networks = client.networks.list(filters={"name": network_name})
-                    networks[0].remove()
-                except NotFound as err:
-                    current_app.logger.warning(
-                        "Unable to find the container to remove (name: '%s'): %s",
-                        name,
-                        err,
-                    )
-                except KeyError as err:
-                    current_app.logger.warning(
-                        "Unable to find the network to remove (name: '%s'): %s",
-                        network_name,
-                        err,
-                    )
-                except APIError as err:
-                    current_app.logger.warning(
-                        "Unable to remove the network (name: '%s'): %s",
-                        network_name,
-                        err,
-                    )
-                return
-
-
-def remove_container_by_id(instance_id: str) -> None:
-    """
-    Remove running container using its instance ID.
-    """
-    instance = Instances.query.filter_by(id=instance_id).first()
-    if instance:
-        remove_container_by_name(instance.host_domain, instance.instance_name)
-        db.session.delete(instance)
-        db.session.commit()
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+Load-test of the deployer: the real Flask app served by waitress, an in-process
+fake Docker daemon and a local CTFd stub.
+
+    python -m bench --scenario all --users 200 --max-instances 500 --web-threads 16
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from statistics import quantiles
+from threading import Lock, Thread
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ["login", "deploy", "steady", "teardown", "ports"]
+
+
+class Stats:
+    """
+    Latencies and errors of the requests, per endpoint.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.windows = {}
+
+    def record(self, endpoint: str, start: float, ok: bool) -> None:
+        end = time.perf_counter()
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(end - start)
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + (not ok)
+            first, last = self.windows.get(endpoint, (start, end))
+            self.windows[endpoint] = (min(first, start), max(last, end))
+
+    def report(self) -> list[dict]:
+        rows = []
+        for endpoint, latencies in self.latencies.items():
+            first, last = self.windows[endpoint]
+            cuts = (
+                quantiles(latencies, n=100, method="inclusive")
+                if len(latencies) > 1
+                else latencies * 99
+            )
+            rows.append(
+                {
+                    "endpoint": endpoint,
+                    "count": len(latencies),
+                    "errors": self.errors[endpoint],
+                    "throughput": len(latencies) / max(last - first, 1e-9),
+                    "p50": cuts[49],
+                    "p99": cuts[98],
+                    "max": max(latencies),
+                }
+            )
+        return rows
+
+
+class Client:
+    """
+    A player (or an admin) with its own cookie jar.
+    """
+
+    def __init__(self, base_url: str, stats: Stats, access_key: str):
+        self.base_url = base_url
+        self.stats = stats
+        self.access_key = access_key
+        self.session = requests.Session()
+
+    def request(self, method: str, endpoint: str, path: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(
+                method,
+                self.base_url + path,
+                allow_redirects=False,
+                timeout=60,
+                **kwargs,
+            )
+        except requests.RequestException:
+            self.stats.record(endpoint, start, False)
+            return None
+        self.stats.record(endpoint, start, response.status_code < 500)
+        return response
+
+    def login(self) -> bool:
+        response = self.request(
+            "POST", "POST /login", "/login", data={"access_key": self.access_key}
+        )
+        return response is not None and response.status_code == 302
+
+    def index(self):
+        return self.request("GET", "GET /", "/")
+
+    def deploy(self, challenge_name: str) -> str:
+        """
+        Request an instance and wait for it, returns the final status.
+        """
+        start = time.perf_counter()
+        self.request(
+            "POST",
+            "POST /run_instance",
+            "/run_instance",
+            data={"challenge_name": challenge_name},
+        )
+        response = self.index()
+        match = re.search(r'data-job-id="([^"]+)"', response.text if response else "")
+        if not match:
+            # Rejected by the admission control or the quotas, or claimed from the
+            # warm pool
+            text = response.text if response else ""
+            if "is ready" in text:
+                status = "ready"
+            elif "please retry in" in text:
+                status = "throttled"
+            else:
+                status = "refused"
+            self.stats.record(f"deploy ({status})", start, True)
+            return status
+
+        status = "queued"
+        while status not in ["ready", "failed"]:
+            time.sleep(0.05)
+            response = self.request("GET", "GET /deploy/<id>", f"/deploy/{match[1]}")
+            if response is None or response.status_code != 200:
+                break
+            status = response.json().get("data", {}).get("status", "failed")
+        self.stats.record(f"deploy ({status})", start, status == "ready")
+        return status
+
+
+def start_app(args: argparse.Namespace, ctfd_url: str) -> str:
+    """
+    Import the app against a generated config.json and serve it with waitress.
+    """
+    import docker
+
+    from bench.fake_docker import FakeDockerClient
+
+    FakeDockerClient.latency = args.docker_latency
+    FakeDockerClient.jitter = args.docker_jitter
+    FakeDockerClient.pull_latency = args.pull_latency
+    FakeDockerClient.failure_rate = args.docker_failure_rate
+    docker.DockerClient = FakeDockerClient
+
+    with open(os.path.join(ROOT, "config.sample.json")) as sample:
+        config = json.load(sample)
+    config.update(
+        {
+            "ctfd_url": ctfd_url,
+            "max_instance_count": args.max_instances,
+            "max_instance_per_team": args.max_instances,
+            "max_instance_duration": 600,
+            "random_ports": {"min": 10000, "max": 60000},
+            "image_pull_interval": 3600,
+            "web_threads": args.web_threads,
+            "hosts": [
+                {
+                    "domain": f"dyn-{i:02}.bench",
+                    "api": f"tcp://dyn-{i:02}.bench:2375",
+                    "max_instances": args.max_instances,
+                }
+                for i in range(args.hosts)
+            ],
+        }
+    )
+    for challenge in config["challenges"]:
+        challenge["warm_pool"] = args.warm_pool
+
+    workdir = tempfile.mkdtemp(prefix="deployer-bench-")
+    with open(os.path.join(workdir, "config.json"), "w") as config_file:
+        json.dump(config, config_file)
+    os.environ["DATABASE_URI"] = args.database_uri or (
+        "sqlite:///" + os.path.join(workdir, "db.sqlite")
+    )
+    os.environ["DEBUG"] = "0"
+    os.environ["ENABLE_RECAPTCHA"] = "0"
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+
+    from waitress.server import create_server
+
+    import run
+
+    run.app.logger.setLevel(logging.WARNING)
+    logging.getLogger("waitress").setLevel(logging.ERROR)
+    server = create_server(run.app, host="127.0.0.1", port=0, threads=args.web_threads)
+    Thread(target=server.run, name="waitress", daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.effective_port}"
+
+    # The challenge hosts are probed in the background
+    for _ in range(300):
+        if requests.get(base_url + "/ready", timeout=5).status_code == 200:
+            break
+        time.sleep(0.1)
+    return base_url
+
+
+def scenario_login(args, base_url: str, stats: Stats) -> list[Client]:
+    """
+    Every user logs in at the same time (start of the CTF).
+    """
+    clients = [
+        Client(base_url, stats, f"ctfd_{user_id}")
+        for user_id in range(1, args.users + 1)
+    ]
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(lambda client: client.login() and client.index(), clients))
+    return clients
+
+
+def scenario_deploy(args, clients: list[Client]) -> dict:
+    """
+    Every user requests an instance at the same time (release of a challenge).
+    """
+    from app.config import CHALLENGES
+
+    names = [challenge.name for challenge in CHALLENGES]
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        statuses = list(
+            executor.map(lambda client: client.deploy(random.choice(names)), clients)
+        )
+    return {status: statuses.count(status) for status in set(statuses)}
+
+
+def scenario_steady(args, clients: list[Client], admin: Client) -> None:
+    """
+    The instances are running (up to the capacity) and the pages are refreshed.
+    """
+    from app.config import CHALLENGES
+
+    names = [challenge.name for challenge in CHALLENGES]
+    deadline = time.monotonic() + args.duration
+
+    def player(client: Client) -> None:
+        while time.monotonic() < deadline:
+            if random.random() < 0.05:
+                client.deploy(random.choice(names))
+            else:
+                client.index()
+            time.sleep(random.uniform(0, 0.2))
+
+    def operator() -> None:
+        while time.monotonic() < deadline:
+            admin.request("GET", "GET /container/all", "/container/all?limit=100")
+            admin.request("GET", "GET /metrics", "/metrics")
+            time.sleep(1)
+
+    with ThreadPoolExecutor(args.concurrency + 1) as executor:
+        futures = [executor.submit(operator)]
+        futures += [executor.submit(player, client) for client in clients]
+        for future in futures:
+            future.result()
+
+
+def scenario_teardown(admin: Client, stats: Stats) -> dict:
+    """
+    The admin removes every instance at once (end of the CTF).
+    """
+    start = time.perf_counter()
+    response = admin.request("DELETE", "DELETE /container/all", "/container/all")
+    if response is None or response.status_code != 202:
+        stats.record("teardown (total)", start, False)
+        return {}
+
+    job = response.json()["data"]
+    while job["status"] == "running":
+        time.sleep(0.1)
+        response = admin.request(
+            "GET", "GET /container/all/<id>", f"/container/all/{job['id']}"
+        )
+        job = response.json()["data"]
+    stats.record("teardown (total)", start, job["status"] == "done")
+    return job
+
+
+def scenario_ports(stats: Stats) -> None:
+    """
+    Micro-benchmark of the port allocation on a nearly full host.
+    """
+    from app.ports import PortAllocator
+
+    for occupancy in [0, 0.5, 0.9, 0.99]:
+        allocator = PortAllocator("bench", 10000, 60000)
+        allocator.mark_used(
+            random.sample(range(10000, 60001), int(allocator.size * occupancy))
+        )
+        for _ in range(1000):
+            start = time.perf_counter()
+            ports = allocator.allocate(2)
+            stats.record(f"PortAllocator.allocate ({occupancy:.0%} used)", start, True)
+            allocator.release(ports)
+
+
+def print_report(rows: list[dict]) -> None:
+    header = f"{'endpoint':<42} {'count':>7} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        print(
+            f"{row['endpoint']:<42} {row['count']:>7} {row['errors']:>7} "
+            f"{row['throughput']:>9.1f} {row['p50'] * 1000:>9.2f} "
+            f"{row['p99'] * 1000:>9.2f} {row['max'] * 1000:>9.2f}"
+        )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__)
+    parser.add_argument("--scenario", choices=SCENARIOS + ["all"], default="all")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--team-size", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--hosts", type=int, default=2)
+    parser.add_argument("--max-instances", type=int, default=500)
+    parser.add_argument("--web-threads", type=int, default=16)
+    parser.add_argument("--warm-pool", type=int, default=0)
+    parser.add_argument("--duration", type=float, default=10, help="steady state (s)")
+    parser.add_argument("--docker-latency", type=float, default=0.01)
+    parser.add_argument("--docker-jitter", type=float, default=0.005)
+    parser.add_argument("--docker-failure-rate", type=float, default=0.0)
+    parser.add_argument("--pull-latency", type=float, default=0.5)
+    parser.add_argument("--ctfd-latency", type=float, default=0.02)
+    parser.add_argument("--database-uri", help="defaults to a temporary sqlite file")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    stats = Stats()
+    summary = {}
+
+    if args.scenario == "ports":
+        sys.path.insert(0, ROOT)
+        start_app(args, "http://127.0.0.1:1")
+        scenario_ports(stats)
+    else:
+        from bench.ctfd_stub import ADMIN_TOKEN, start_ctfd_stub
+
+        ctfd = start_ctfd_stub(args.ctfd_latency, args.team_size)
+        base_url = start_app(args, f"http://127.0.0.1:{ctfd.server_port}")
+
+        admin = Client(base_url, stats, ADMIN_TOKEN)
+        admin.login()
+        clients = scenario_login(args, base_url, stats)
+
+        if args.scenario in ["deploy", "steady", "all"]:
+            summary["deploy"] = scenario_deploy(args, clients)
+        if args.scenario in ["steady", "all"]:
+            scenario_steady(args, clients, admin)
+        if args.scenario in ["teardown", "all"]:
+            if args.scenario == "teardown":
+                summary["deploy"] = scenario_deploy(args, clients)
+            summary["teardown"] = scenario_teardown(admin, stats)
+        if args.scenario == "all":
+            scenario_ports(stats)
+
+    rows = stats.report()
+    if args.json:
+        print(json.dumps({"args": vars(args), "summary": summary, "endpoints": rows}))
+    else:
+        print_report(rows)
+        for name, value in summary.items():
+            print(f"{name}: {json.dumps(value, default=str)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+import json
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+ADMIN_TOKEN = "ctfd_admin"
+
+
+class CTFdStubHandler(BaseHTTPRequestHandler):
+    """
+    Answers the CTFd API calls of the app. The access key `ctfd_<n>` is the user
+    n of the team `n // team_size + 1`, `ctfd_admin` is an administrator.
+    """
+
+    server_version = "CTFdStub/1.0"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def send_json(self, status: int, data: dict) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        time.sleep(self.server.latency)
+        token = self.headers.get("Authorization", "").removeprefix("Token ")
+
+        if token == ADMIN_TOKEN:
+            user_id, team_id = 0, 1
+        elif re.match(r"^ctfd_[0-9]+$", token):
+            user_id = int(token[len("ctfd_") :])
+            team_id = user_id // self.server.team_size + 1
+        else:
+            self.send_json(401, {"success": False})
+            return
+
+        if self.path == "/api/v1/users/me":
+            self.send_json(
+                200,
+                {
+                    "success": True,
+                    "data": {
+                        "id": user_id,
+                        "name": f"user{user_id}",
+                        "team_id": team_id,
+                    },
+                },
+            )
+        elif self.path.startswith("/api/v1/teams/"):
+            team_id = self.path.rsplit("/", 1)[-1]
+            self.send_json(200, {"success": True, "data": {"name": f"team{team_id}"}})
+        elif self.path == "/api/v1/configs":
+            if token == ADMIN_TOKEN:
+                self.send_json(200, {"success": True, "data": []})
+            else:
+                self.send_json(403, {"success": False})
+        else:
+            self.send_json(404, {"success": False})
+
+
+def start_ctfd_stub(latency: float = 0.01, team_size: int = 1) -> ThreadingHTTPServer:
+    """
+    Serve the stub on a random local port in a background thread.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CTFdStubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.team_size = team_size
+    Thread(target=server.serve_forever, name="ctfd-stub", daemon=True).start()
+    return server
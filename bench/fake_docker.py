@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+import itertools
+import random
+import time
+from threading import Lock
+
+import requests
+from docker.errors import APIError, ImageNotFound, NotFound
+
+IDS = itertools.count(1)
+
+
+def error_response(status_code: int) -> requests.Response:
+    """
+    HTTP response attached to the errors of the daemon, like docker-py does.
+    """
+    response = requests.Response()
+    response.status_code = status_code
+    return response
+
+
+class FakeObject:
+    def __init__(self, collection, name: str, attrs: dict):
+        self.collection = collection
+        self.client = collection.client
+        self.id = f"{next(IDS):064x}"
+        self.name = name
+        self.attrs = attrs
+
+    @property
+    def labels(self) -> dict:
+        return self.attrs.get("Labels") or self.attrs.get("Config", {}).get(
+            "Labels", {}
+        )
+
+    def reload(self) -> None:
+        self.client.call("inspect")
+
+
+class FakeContainer(FakeObject):
+    @property
+    def status(self) -> str:
+        return "running"
+
+    def reload(self) -> None:
+        super().reload()
+        with self.client.lock:
+            for network_name, settings in self.attrs["NetworkSettings"][
+                "Networks"
+            ].items():
+                endpoint = (
+                    self.client.networks.items[network_name]
+                    .attrs["Containers"]
+                    .get(self.id, {})
+                )
+                settings["IPAddress"] = endpoint.get("IPv4Address", "").split("/")[0]
+
+    def remove(self, force: bool = False) -> None:
+        self.client.call("containers.remove")
+        with self.client.lock:
+            if self.collection.items.pop(self.name, None) is None:
+                raise NotFound(f"No such container: {self.name}", error_response(404))
+            for network in self.client.networks.items.values():
+                network.attrs["Containers"].pop(self.id, None)
+
+
+class FakeNetwork(FakeObject):
+    def remove(self) -> None:
+        self.client.call("networks.remove")
+        with self.client.lock:
+            if self.attrs["Containers"]:
+                raise APIError(
+                    f"network {self.name} has active endpoints", error_response(403)
+                )
+            if self.collection.items.pop(self.name, None) is None:
+                raise NotFound(f"No such network: {self.name}", error_response(404))
+
+
+class FakeCollection:
+    def __init__(self, client):
+        self.client = client
+        self.items = {}
+
+    def get(self, key: str):
+        self.client.call("inspect")
+        with self.client.lock:
+            for item in self.items.values():
+                if key in [item.name, item.id]:
+                    return item
+        raise NotFound(key, error_response(404))
+
+    def list(
+        self,
+        all: bool = False,
+        names: list = None,
+        filters: dict = None,
+        sparse: bool = False,
+    ):
+        self.client.call("list")
+        with self.client.lock:
+            items = list(self.items.values())
+
+        if names is not None:
+            items = [item for item in items if item.name in names]
+        # Substring match of any of the names, like the daemon
+        if (filters or {}).get("name"):
+            items = [
+                item
+                for item in items
+                if any(name in item.name for name in filters["name"])
+            ]
+        for label in (filters or {}).get("label", []):
+            key, _, value = label.partition("=")
+            items = [
+                item
+                for item in items
+                if key in item.labels and (not value or item.labels[key] == value)
+            ]
+        return items
+
+
+class FakeContainers(FakeCollection):
+    def run(self, image: str, name: str, network: str, **kwargs) -> FakeContainer:
+        self.client.call("containers.run")
+        if image not in self.client.images.items:
+            raise ImageNotFound(f"No such image: {image}", error_response(404))
+
+        with self.client.lock:
+            if network not in self.client.networks.items:
+                raise NotFound(f"No such network: {network}", error_response(404))
+            ip_address = f"10.{len(self.items) // 65536 % 256}.{len(self.items) // 256 % 256}.{len(self.items) % 256}"
+            container = FakeContainer(
+                self,
+                name,
+                {
+                    "Name": f"/{name}",
+                    # Keys of the sparse listing
+                    "Names": [f"/{name}"],
+                    "Labels": kwargs.get("labels") or {},
+                    "Ports": [
+                        {
+                            "PrivatePort": int(port.split("/")[0]),
+                            "PublicPort": host_port,
+                            "Type": port.split("/")[-1],
+                        }
+                        for port, host_port in (kwargs.get("ports") or {}).items()
+                    ],
+                    "Config": {"Image": image, "Labels": kwargs.get("labels") or {}},
+                    # Inspected before the start, like docker-py: no address yet
+                    "NetworkSettings": {
+                        "Networks": {network: {"IPAddress": ""}},
+                        "Ports": {
+                            port: [{"HostIp": "0.0.0.0", "HostPort": str(host_port)}]
+                            for port, host_port in (kwargs.get("ports") or {}).items()
+                        },
+                    },
+                },
+            )
+            self.items[name] = container
+            self.client.networks.items[network].attrs["Containers"][container.id] = {
+                "Name": name,
+                "IPv4Address": f"{ip_address}/16",
+            }
+        return container
+
+
+class FakeNetworks(FakeCollection):
+    def create(self, name: str, **kwargs) -> FakeNetwork:
+        self.client.call("networks.create")
+        with self.client.lock:
+            network = FakeNetwork(
+                self,
+                name,
+                {"Name": name, "Labels": kwargs.get("labels") or {}, "Containers": {}},
+            )
+            self.items[name] = network
+        return network
+
+
+class FakeImage:
+    def __init__(self, name: str):
+        self.id = f"sha256:{abs(hash(name)):064x}"
+        self.tags = [name]
+
+
+class FakeImages:
+    def __init__(self, client):
+        self.client = client
+        self.items = {}
+
+    def get(self, name: str) -> FakeImage:
+        self.client.call("images.inspect")
+        if name not in self.items:
+            raise ImageNotFound(f"No such image: {name}", error_response(404))
+        return self.items[name]
+
+    def pull(self, name: str, tag: str = None) -> FakeImage:
+        self.client.call("images.pull", self.client.pull_latency)
+        name = f"{name}:{tag}" if tag else name
+        self.items[name] = FakeImage(name)
+        return self.items[name]
+
+
+class FakeAPIClient:
+    """
+    Low-level client, only holds the settings applied by app.hosts.
+    """
+
+    def __init__(self, base_url: str, timeout=None):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.adapters = {}
+
+    def mount(self, prefix: str, adapter) -> None:
+        self.adapters[prefix] = adapter
+
+
+class FakeDockerClient:
+    """
+    In-process replacement of docker.DockerClient. The latency and the failure
+    rate of the API calls are class attributes set by the benchmark.
+    """
+
+    latency = 0.005
+    jitter = 0.002
+    pull_latency = 1.0
+    failure_rate = 0.0
+
+    def __init__(self, base_url: str = None, **kwargs):
+        self.api = FakeAPIClient(base_url, kwargs.get("timeout"))
+        self.lock = Lock()
+        self.containers = FakeContainers(self)
+        self.networks = FakeNetworks(self)
+        self.images = FakeImages(self)
+
+    def call(self, operation: str, latency: float = None) -> None:
+        """
+        Simulate the round trip of an API call, raises APIError at `failure_rate`.
+        """
+        latency = self.latency if latency is None else latency
+        time.sleep(max(latency + random.uniform(-self.jitter, self.jitter), 0))
+        if random.random() < self.failure_rate:
+            raise APIError(f"Injected failure on {operation}")
+
+    def events(self, since=None, until=None, filters=None, decode=None):
+        """
+        Stream without events, open until `until` like the daemon.
+        """
+        self.call("events")
+        time.sleep(max((until or time.time()) - time.time(), 0))
+        return iter(())
+
+    def ping(self) -> bool:
+        self.call("ping")
+        return True
+
+    def close(self) -> None:
+        pass
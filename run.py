@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 from datetime import datetime, timedelta
-from typing import Any
+from typing import Any, Optional
 
 from flask import (
+    Response,
     current_app,
     flash,
     jsonify,
@@ -10,32 +11,48 @@ from flask import (
     render_template,
     request,
     session,
+    stream_with_context,
     url_for,
 )
 from flask_recaptcha import ReCaptcha
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
 
+from app.admin import InstanceListing
+from app.admission import ADMISSION
 from app.app import create_app
 from app.auth import admin_required, login_required
+from app.cluster import LEADER
 from app.config import (
     ADMIN_ONLY,
     CHALLENGES,
     CTFD_URL,
-    MAX_INSTANCE_COUNT,
+    INSTANCE_EXTENSION,
     MAX_INSTANCE_DURATION,
+    MAX_INSTANCE_EXTENSIONS,
     MAX_INSTANCE_PER_TEAM,
+    METRICS_TOKEN,
+    WEB_THREADS,
     WEBSITE_TITLE,
 )
-from app.models import Instances
+from app.counters import COUNTERS
+from app.database import db
+from app.events import EVENTS
+from app.hosts import HOSTS
+from app.images import IMAGE_WARMER
+from app.jobs import DEPLOY_QUEUE
+from app.metrics import DEPLOY_STAGE_SECONDS, REGISTRY
+from app.models import Deployments, Instances
+from app.pool import claim_pooled_deployment
+from app.reaper import REAPER
+from app.reconciler import RECONCILER
+from app.teardown import TEARDOWN_JOBS, remove_all_instances, remove_deployments
 from app.utils import (
     check_access_key,
     check_challenge_name,
-    create_instances,
-    get_challenge_count_per_team,
+    extend_deployment,
     get_challenge_info,
     get_total_instance_count,
-    remove_all_instances,
-    remove_container_by_id,
-    remove_old_instances,
     remove_user_running_instance,
 )
 
@@ -54,19 +71,168 @@ def render(template: str, **kwargs: Any) -> str:
         ctfd_url=CTFD_URL,
         max_instance_duration=MAX_INSTANCE_DURATION,
         max_instance_per_team=MAX_INSTANCE_PER_TEAM,
+        max_instance_extensions=MAX_INSTANCE_EXTENSIONS,
+        instance_extension=INSTANCE_EXTENSION,
         challenges_option=CHALLENGES,
         instances_count=get_total_instance_count(),
+        events_cursor=EVENTS.last_id,
         **kwargs,
     )
 
 
+def get_pending_deploy_job() -> Optional[str]:
+    """
+    Returns the ID of the deployment the user is waiting for, if any.
+    """
+    job = DEPLOY_QUEUE.get(session.get("deploy_job", ""))
+    if not job or job.finished:
+        session.pop("deploy_job", None)
+        return None
+    return job.id
+
+
 @app.route("/admin", methods=["GET"])
 @admin_required
 def admin():
     """
     Admin dashboard with all instances.
     """
-    return render("admin.html")
+    return render(
+        "admin.html",
+        reaper=REAPER.stats(),
+        images=IMAGE_WARMER.status(),
+        hosts=HOSTS.status(),
+        admission=ADMISSION.stats(),
+        cluster=LEADER.status(),
+    )
+
+
+@app.route("/admin/reaper", methods=["GET"])
+@admin_required
+def reaper_stats():
+    """
+    Admin restricted function to retrieve the lag and backlog of the reaper.
+    """
+    return jsonify({"success": True, "data": REAPER.stats()})
+
+
+@app.route("/admin/reconciler", methods=["GET"])
+@admin_required
+def reconciler_stats():
+    """
+    Admin restricted function to retrieve what the last reconciliation removed.
+    """
+    return jsonify({"success": True, "data": RECONCILER.stats()})
+
+
+@app.route("/admin/admission", methods=["GET"])
+@admin_required
+def admission_stats():
+    """
+    Admin restricted function to retrieve the rejections of the admission control,
+    the create/remove operations per host and the deploy queue.
+    """
+    return jsonify(
+        {
+            "success": True,
+            "data": {
+                **ADMISSION.stats(),
+                "queue": {
+                    "size": DEPLOY_QUEUE.queue.qsize(),
+                    "max_size": DEPLOY_QUEUE.queue.maxsize,
+                    "retry_after": round(DEPLOY_QUEUE.retry_after(), 1),
+                },
+            },
+        }
+    )
+
+
+@app.route("/admin/cluster", methods=["GET"])
+@admin_required
+def cluster_status():
+    """
+    Admin restricted function to retrieve the replica serving the request and the
+    leader replica.
+    """
+    return jsonify({"success": True, "data": LEADER.status()})
+
+
+@app.route("/admin/counters", methods=["GET"])
+@admin_required
+def counters_stats():
+    """
+    Admin restricted function to retrieve the live counters and their last drift.
+    """
+    return jsonify({"success": True, "data": COUNTERS.stats()})
+
+
+@app.route("/admin/images", methods=["GET"])
+@admin_required
+def images_status():
+    """
+    Admin restricted function to retrieve the pull status of the images on each host.
+    """
+    return jsonify({"success": True, "data": IMAGE_WARMER.status()})
+
+
+@app.route("/admin/hosts", methods=["GET"])
+@admin_required
+def hosts_status():
+    """
+    Admin restricted function to retrieve the health of the challenge hosts.
+    """
+    return jsonify({"success": True, "data": HOSTS.status()})
+
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    """
+    Readiness probe: 200 once the database answers and at least one challenge host
+    is available, with the hosts and the missing images of each host.
+    """
+    try:
+        db.session.execute(text("SELECT 1"))
+        database = True
+    except SQLAlchemyError as err:
+        current_app.logger.error("Database unavailable: %s", err)
+        database = False
+
+    hosts = HOSTS.status()
+    images = IMAGE_WARMER.status()
+    data = {
+        "database": database,
+        "hosts": {
+            host_domain: {
+                "state": health["state"],
+                "missing_images": [
+                    image
+                    for image, image_status in images.get(host_domain, {}).items()
+                    if image_status["status"] != "present"
+                ],
+            }
+            for host_domain, health in hosts.items()
+        },
+    }
+    data["ready"] = database and any(
+        health["state"] == "closed" for health in hosts.values()
+    )
+    return jsonify({"success": True, "data": data}), 200 if data["ready"] else 503
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Metrics in the Prometheus text format, protected by `metrics_token`. Without
+    a token, only the admins and the local scrapers are allowed.
+    """
+    if METRICS_TOKEN:
+        allowed = request.headers.get("Authorization") == f"Bearer {METRICS_TOKEN}"
+    else:
+        allowed = session.get("admin") or request.remote_addr in ("127.0.0.1", "::1")
+    if not allowed:
+        return Response("Unauthorized\n", status=401, mimetype="text/plain")
+
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/login", methods=["GET", "POST"])
@@ -112,76 +278,102 @@ def login():
     return redirect(url_for("login"))
 
 
+def get_challenges_info(deployments: list[Deployments]) -> dict[str, list[dict]]:
+    """
+    Returns the containers shown on the card of each deployment.
+    """
+    challenges_info = {}
+    for deployment in deployments:
+        remaining = deployment.deadline - datetime.utcnow()
+        if remaining > timedelta(seconds=0):
+            remaining = f"{remaining.seconds // 60:02d}m{remaining.seconds % 60:02d}s"
+        else:
+            remaining = "This instance will be deleted shortly..."
+
+        challenges_info[deployment.network_name] = [
+            {
+                "name": deployment.challenge_name,
+                "host": deployment.host_domain,
+                "hostname": instance.hostname,
+                "ip_address": instance.ip_address,
+                "ports": instance.ports,
+                "user_name": deployment.user_name,
+                "time_remaining": remaining,
+                "deadline": deployment.deadline.isoformat() + "Z",
+                "state": deployment.state,
+                "extensions_left": MAX_INSTANCE_EXTENSIONS - deployment.extensions,
+            }
+            for instance in deployment.instances
+        ]
+    return challenges_info
+
+
 @app.route("/", methods=["GET"])
 @login_required
 def index():
     """
     Display running instances of your team and allows you to submit new instances.
     """
-    instances = Instances.query.filter_by(team_id=session["team_id"]).all()
-
-    if instances:
-        challenges_info = {}
-
-        for instance in instances:
-            if instance.network_name not in challenges_info:
-                challenges_info[instance.network_name] = []
+    deployments = Deployments.query.filter_by(team_id=session["team_id"]).all()
+
+    return render(
+        "index.html",
+        challenges=CHALLENGES,
+        captcha=recaptcha,
+        challenges_info=get_challenges_info(deployments),
+        deploy_job=get_pending_deploy_job(),
+    )
 
-            remaining = timedelta(minutes=MAX_INSTANCE_DURATION) - (
-                datetime.utcnow() - instance.creation_date
-            )
-            if remaining > timedelta(seconds=0):
-                remaining = (
-                    f"{remaining.seconds // 60:02d}m{remaining.seconds % 60:02d}s"
-                )
-            else:
-                remaining = "This instance will be deleted shortly..."
-
-            challenges_info[instance.network_name].append(
-                {
-                    "name": instance.challenge_name,
-                    "host": instance.host_domain,
-                    "hostname": instance.hostname,
-                    "ip_address": instance.ip_address,
-                    "ports": instance.ports,
-                    "user_name": instance.user_name,
-                    "time_remaining": remaining,
-                }
-            )
 
-        return render(
-            "index.html",
-            challenges=CHALLENGES,
-            captcha=recaptcha,
-            challenges_info=challenges_info,
+@app.route("/instances/<network_name>", methods=["GET"])
+@login_required
+def instance_card(network_name=None):
+    """
+    Returns the card of a deployment of the team (None once removed) and the number
+    of running containers, so that the page updates a single card on each event.
+    """
+    deployment = Deployments.query.filter_by(
+        network_name=network_name, team_id=session["team_id"]
+    ).first()
+
+    html = None
+    if deployment:
+        html = render_template(
+            "instance_card.html",
+            network_name=deployment.network_name,
+            containers=get_challenges_info([deployment])[deployment.network_name],
+            instance_extension=INSTANCE_EXTENSION,
         )
-    return render("index.html", challenges=CHALLENGES, captcha=recaptcha)
+    return jsonify(
+        {
+            "success": True,
+            "data": {"html": html, "instances_count": get_total_instance_count()},
+        }
+    )
 
 
 @app.route("/container/all", methods=["GET"])
 @admin_required
 def get_all_containers():
     """
-    Admin restricted function to retrieve all containers.
+    Admin restricted function to retrieve the containers, filtered by team, user,
+    image or host (or q), sorted by id or date and paginated with `next_cursor`.
     """
-    return jsonify(
-        {
-            "success": True,
-            "data": [
-                {
-                    "id": instance.id,
-                    "team": instance.team_name,
-                    "username": instance.user_name,
-                    "image": instance.docker_image,
-                    "domain": instance.host_domain,
-                    "ports": instance.ports,
-                    "instance_name": instance.instance_name,
-                    "date": instance.creation_date,
-                }
-                for instance in Instances.query.all()
-            ],
-        }
-    )
+    try:
+        listing = InstanceListing(request.args)
+    except ValueError as err:
+        return jsonify({"success": False, "message": str(err)}), 400
+
+    etag = listing.etag()
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(
+            stream_with_context(listing.stream()), mimetype="application/json"
+        )
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 
 @app.route("/container/all", methods=["DELETE"])
@@ -190,18 +382,47 @@ def remove_containers():
     """
     Admin restricted function to remove all containers.
     """
-    remove_all_instances()
+    job = remove_all_instances(current_app._get_current_object())
+
+    return (
+        jsonify(
+            {
+                "success": True,
+                "message": "Instances are being removed.",
+                "data": job.to_dict(),
+            }
+        ),
+        202,
+    )
 
-    return jsonify({"success": True, "message": "Instances removed successfully."})
+
+@app.route("/container/all/<job_id>", methods=["GET"])
+@admin_required
+def remove_containers_progress(job_id=None):
+    """
+    Admin restricted function to follow the removal of all containers.
+    """
+    if job_id not in TEARDOWN_JOBS:
+        return jsonify({"success": False, "message": "Unknown job."}), 404
+
+    return jsonify({"success": True, "data": TEARDOWN_JOBS[job_id].to_dict()})
 
 
 @app.route("/container/<int:container_id>", methods=["DELETE"])
 @admin_required
 def remove_container(container_id=None):
     """
-    Admin restricted function to remove a container with its ID.
+    Admin restricted function to remove the deployment of a container with its ID.
     """
-    remove_container_by_id(container_id)
+    instance = Instances.query.filter_by(id=container_id).first()
+    if not instance:
+        return jsonify({"success": False, "message": "Unable to find the instance."})
+
+    job = remove_deployments(
+        current_app._get_current_object(), [instance.deployment.network_name]
+    )
+    if job.status != "done":
+        return jsonify({"success": False, "message": "Unable to remove the instance."})
 
     return jsonify({"success": True, "message": "Instances removed successfully."})
 
@@ -220,6 +441,78 @@ def remove_me():
     )
 
 
+@app.route("/instance/reset", methods=["POST"])
+@login_required
+def reset_instance():
+    """
+    Allow a user to recreate the containers of their instance, keeping its network,
+    hostnames and ports.
+    """
+    deployment = Deployments.query.filter_by(user_id=session["user_id"]).first()
+    if not deployment:
+        return jsonify(
+            {"success": False, "message": "Unable to find an instance to reset."}
+        )
+
+    challenge = get_challenge_info(deployment.challenge_name)
+    if challenge is None:
+        return jsonify(
+            {
+                "success": False,
+                "message": "This instance cannot be reset, please redeploy it.",
+            }
+        )
+
+    if DEPLOY_QUEUE.get_user_job(session["user_id"]):
+        return jsonify(
+            {"success": False, "message": "You already have a deployment in progress."}
+        )
+
+    admitted, message = ADMISSION.admit(session["user_id"], session["team_id"])
+    if not admitted:
+        return jsonify({"success": False, "message": message})
+
+    user = {
+        "user_id": session["user_id"],
+        "user_name": session["user_name"],
+        "team_id": session["team_id"],
+        "team_name": session["team_name"],
+    }
+    job = DEPLOY_QUEUE.submit(user, challenge, network_name=deployment.network_name)
+    if not job:
+        return jsonify(
+            {
+                "success": False,
+                "message": ADMISSION.reject("queue", DEPLOY_QUEUE.retry_after()),
+            }
+        )
+
+    session["deploy_job"] = job.id
+    return jsonify(
+        {
+            "success": True,
+            "message": job.message,
+            "data": job.to_dict(),
+        }
+    )
+
+
+@app.route("/instance/extend", methods=["POST"])
+@login_required
+def extend_instance():
+    """
+    Allow a user to extend the lifetime of their instance.
+    """
+    deployment = Deployments.query.filter_by(user_id=session["user_id"]).first()
+    if not deployment:
+        return jsonify(
+            {"success": False, "message": "Unable to find an instance to extend."}
+        )
+
+    success, message = extend_deployment(deployment)
+    return jsonify({"success": success, "message": message})
+
+
 @app.route("/logout", methods=["GET"])
 def logout():
     """
@@ -248,53 +541,102 @@ def run_instance():
         flash("Please provide a challenge name.", "red")
         return redirect(url_for("index"))
 
-    remove_old_instances()
-
     if not check_challenge_name(challenge_name):
         flash("The challenge name is not valid.", "red")
         return redirect(url_for("index"))
 
-    if get_challenge_count_per_team(session["team_id"]) >= MAX_INSTANCE_PER_TEAM:
-        flash(
-            f"Your team has reached the maximum number of concurrent running instances ({MAX_INSTANCE_PER_TEAM}).",
-            "red",
-        )
+    job = DEPLOY_QUEUE.get_user_job(session["user_id"])
+    if job:
+        flash("You already have a deployment in progress.", "red")
+        session["deploy_job"] = job.id
         return redirect(url_for("index"))
 
-    remove_user_running_instance(session["user_id"])
+    admitted, message = ADMISSION.admit(session["user_id"], session["team_id"])
+    if not admitted:
+        flash(message, "red")
+        return redirect(url_for("index"))
 
-    if get_total_instance_count() > MAX_INSTANCE_COUNT:
-        flash(
-            f"The maximum number of dynamic instances has been reached (max: {MAX_INSTANCE_COUNT}).",
-            "red",
+    challenge = get_challenge_info(challenge_name)
+    user = {
+        "user_id": session["user_id"],
+        "user_name": session["user_name"],
+        "team_id": session["team_id"],
+        "team_name": session["team_name"],
+    }
+
+    # The pooled containers already count in the total, a claim only needs a slot
+    # of the team
+    if challenge.warm_pool:
+        with DEPLOY_STAGE_SECONDS.time(stage="quota"):
+            reservation, message = COUNTERS.reserve(session["team_id"], 0)
+        if not reservation:
+            flash(message, "red")
+            return redirect(url_for("index"))
+
+        claimed = claim_pooled_deployment(user, challenge_name, reservation)
+        COUNTERS.release(reservation)
+        if claimed:
+            flash(f"Your instance of {challenge_name} is ready.", "green")
+            return redirect(url_for("index"))
+
+    # Check the quotas and hold the capacity until the deployment is saved
+    with DEPLOY_STAGE_SECONDS.time(stage="quota"):
+        reservation, message = COUNTERS.reserve(
+            session["team_id"], len(challenge.containers)
         )
+    if not reservation:
+        flash(message, "red")
+        return redirect(url_for("index"))
+
+    job = DEPLOY_QUEUE.submit(user, challenge, reservation)
+    if not job:
+        COUNTERS.release(reservation)
+        flash(ADMISSION.reject("queue", DEPLOY_QUEUE.retry_after()), "red")
         return redirect(url_for("index"))
 
-    challenge_info = get_challenge_info(challenge_name)
+    session["deploy_job"] = job.id
+    flash(f"Your deployment of {challenge_name} is queued...", "green")
+    return redirect(url_for("index"))
+
 
-    nb_container = 0
+@app.route("/events", methods=["GET"])
+@login_required
+def events():
+    """
+    Server-Sent Events of the deployments lifecycle, of the team of the user (of
+    all teams for the admins). The stream is closed once the pending events are
+    sent and resumed by the browser from the Last-Event-ID header, or from the
+    `after` cursor rendered in the page on the first connection.
+    """
     try:
-        nb_container = create_instances(session, challenge_info)
-    except Exception as e:
-        current_app.logger.error(f"Error while creating instances: {e}")
-
-    if nb_container == 1:
-        flash(f"{nb_container} container is starting for {challenge_name}...", "green")
-    elif nb_container > 1:
-        flash(
-            f"{nb_container} containers are starting for {challenge_name}...", "green"
-        )
-    else:
-        flash(
-            "An error occurred while creating your instance. Please contact an administrator.",
-            "red",
+        last_id = int(
+            request.headers.get("Last-Event-ID") or request.args.get("after", "")
         )
+    except ValueError:
+        last_id = None
 
-    return redirect(url_for("index"))
+    team_id = None if session["admin"] else session["team_id"]
+    response = Response(EVENTS.stream(last_id, team_id), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@app.route("/deploy/<job_id>", methods=["GET"])
+@login_required
+def deploy_status(job_id=None):
+    """
+    Returns the status of a deployment (queued, pulling, starting, ready or failed).
+    """
+    job = DEPLOY_QUEUE.get(job_id)
+    if not job or job.user["user_id"] != session["user_id"]:
+        return jsonify({"success": False, "message": "Unable to find the deployment."})
+
+    return jsonify({"success": True, "data": job.to_dict()})
 
 
 if __name__ == "__main__":
     from waitress import serve
 
-    serve(app, host="0.0.0.0", port=5000)
+    serve(app, host="0.0.0.0", port=5000, threads=WEB_THREADS)
     # app.run(host="0.0.0.0", port=5000)